@@ -0,0 +1,124 @@
+# Batch (de)compression of many ISO or CSO images, sharing a single pool of workers
+import sys, os, glob, getopt, time
+from concurrent.futures import ThreadPoolExecutor
+from CSOc2 import compress, min_align, b2mb, FRAME_SIZE
+from CSOd import read_header, decompress
+
+def find(args, ext):
+    "Expand directories (recursively) and globs to a sorted list of files with extension 'ext'"
+    names = set()
+    for arg in args:
+        if os.path.isdir(arg):
+            for root, dirs, files in os.walk(arg):
+                names.update(os.path.join(root, f) for f in files if f.lower().endswith(ext))
+        else:
+            names.update(f for f in glob.glob(arg) if os.path.isfile(f))
+    return sorted(names)
+
+def up_to_date(src, dst):
+    "Tell if the output 'dst' exists and is newer than its source"
+    return os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src)
+
+def convert(src, dst, pool, unpack, frame_size, level, prefilter):
+    """Convert a single image, with frames (de)compressed by a shared 'pool'.
+    Output goes to a temporary file, renamed at the end.
+    Return input and output sizes, and the bad blocks"""
+    tmp = dst + '.part'
+    bad = []
+    try:
+        with open(src, 'rb') as i, open(tmp, 'w+b') as o:
+            if unpack:
+                iso_size, fs, align = read_header(i)
+                bad = decompress(i, o, iso_size, fs, align, pool, verbose=False)
+            else:
+                iso_size = i.seek(0, 2)
+                i.seek(0)
+                compress(i, o, iso_size, frame_size, level, pool, prefilter, min_align(iso_size, frame_size), verbose=False)
+            size = o.seek(0, 2)
+    except:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+    os.replace(tmp, dst)
+    return os.path.getsize(src), size, bad
+
+
+if __name__ == '__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 'dj:k:f:l:po:')
+    if not args:
+        print('ERROR: some directories, ISO or CSO images MUST be specified!')
+        print('Use: CSObatch.py [-d] [-j N] [-k N] [-f KB] [-l N] [-p] [-o DIR] <dir | glob | file> ...\n')
+        print('Compresses all ISO images (or expands all CSO images with -d) found in')
+        print('directories or matching globs, skipping the outputs already up to date.')
+        print('  -d      expand CSO to ISO images, instead of compressing ISO images')
+        print('  -j N    threads shared by all images (default: one per CPU)')
+        print('  -k N    images converted at the same time (default: 2)')
+        print('  -f KB   frame size, from 2 to 32 KB (default: 8)')
+        print('  -l N    compression level (default: 9)')
+        print('  -p      store frames that look incompressible without deflating them')
+        print('  -o DIR  put outputs in DIR, instead of near their inputs')
+        sys.exit(1)
+
+    unpack = prefilter = False
+    jobs = os.cpu_count()
+    images = 2
+    frame_size = FRAME_SIZE
+    level = 9
+    outdir = None
+    for o, a in opts:
+        if o == '-d':
+            unpack = True
+        if o == '-j':
+            jobs = int(a) or os.cpu_count()
+        if o == '-k':
+            images = max(1, int(a))
+        if o == '-f':
+            frame_size = int(a)<<10
+        if o == '-l':
+            level = int(a)
+        if o == '-p':
+            prefilter = True
+        if o == '-o':
+            outdir = a
+
+    if frame_size & (frame_size-1) or not 2048 <= frame_size <= 32768:
+        print('ERROR: frame size must be 2, 4, 8, 16 or 32 KB!')
+        sys.exit(1)
+
+    if outdir:
+        os.makedirs(outdir, exist_ok=True)
+
+    src_ext, dst_ext = ('.cso', '.iso') if unpack else ('.iso', '.cso')
+    todo = []
+    skipped = 0
+    for src in find(args, src_ext):
+        dst = os.path.splitext(src)[0] + dst_ext
+        if outdir:
+            dst = os.path.join(outdir, os.path.basename(dst))
+        if up_to_date(src, dst):
+            skipped += 1
+        else:
+            todo += [(src, dst)]
+    print('%d image(s) to %s, %d already up to date' % (len(todo), 'expand' if unpack else 'compress', skipped))
+
+    # Frames go to a single pool: since every image keeps only a few chunks in
+    # flight, frames of different images interleave and keep all workers busy
+    total_in = total_out = failed = 0
+    t = time.perf_counter()
+    with ThreadPoolExecutor(jobs) as pool, ThreadPoolExecutor(images) as drivers:
+        futures = {drivers.submit(convert, src, dst, pool, unpack, frame_size, level, prefilter): src for src, dst in todo}
+        for f in futures:
+            src = futures[f]
+            try:
+                size_in, size_out, bad = f.result()
+            except Exception as e:
+                print('FAILED %s: %s' % (src, e))
+                failed += 1
+                continue
+            total_in += size_in
+            total_out += size_out
+            print('%s: %.02f MB -> %.02f MB%s' % (src, b2mb(size_in), b2mb(size_out), ', %d bad block(s)!' % len(bad) if bad else ''))
+    t = time.perf_counter() - t
+
+    print('\nOK. %d image(s) converted, %d failed, %d skipped.' % (len(todo)-failed, failed, skipped))
+    if total_in:
+        print('%.02f MB -> %.02f MB in %.1f s (%.02f MB/s).' % (b2mb(total_in), b2mb(total_out), t, b2mb(max(total_in, total_out))/t))
@@ -0,0 +1,140 @@
+# Throughput benchmark for the CSO (de)compressor, on reproducible synthetic ISO images
+import sys, os, time, json, getopt, random, tempfile, platform
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+import CSOc2, CSOd
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+SECTOR = 2048
+WORDS = b'the of and to in is PSP UMD game data file sector frame level save load menu ' \
+        b'stage player score 0 1 2 3 4 5 6 7 8 9 = ; { } ( ) < > / \\ : \r\n'.split(b' ')
+
+def make_iso(name, size, mix=(1,2,1), seed=0):
+    """Write a 'size' bytes synthetic ISO of zero, text-like and random sectors,
+    mixed according to the weights in 'mix'. The same seed makes the same image"""
+    r = random.Random(seed)
+    text = b' '.join(r.choice(WORDS) for i in range(1<<16)) # a pool to slice text sectors from
+    with open(name, 'wb') as f:
+        for i in range(size//SECTOR):
+            kind = r.choices((0,1,2), mix)[0]
+            if kind == 0:
+                f.write(bytes(SECTOR))
+            elif kind == 1:
+                j = r.randrange(len(text)-SECTOR)
+                f.write(text[j : j+SECTOR])
+            else:
+                f.write(r.randbytes(SECTOR))
+
+def peak_rss():
+    "Get the peak resident set size of this process in MB, if known"
+    if not resource: return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': return rss / (1<<20) # bytes
+    return rss / (1<<10) # KB
+
+def run(q, op, iso, cso, frame_size, level, jobs, prefilter):
+    "Run a single benchmark case in a child process, so its peak RSS is its own"
+    sys.stdout = open(os.devnull, 'w') # silence progress
+    pool = None
+    if jobs > 1:
+        pool = ThreadPoolExecutor(jobs)
+    iso_size = os.path.getsize(iso)
+    t = time.perf_counter()
+    if op == 'c':
+        with open(iso, 'rb') as i, open(cso, 'w+b') as o:
+            CSOc2.compress(i, o, iso_size, frame_size, level, pool, prefilter)
+    else:
+        with open(cso, 'rb') as i, open(iso+'.out', 'wb') as o:
+            iso_size, frame_size, align = CSOd.read_header(i)
+            CSOd.decompress(i, o, iso_size, frame_size, align, pool)
+    t = time.perf_counter() - t
+    if pool: pool.shutdown()
+    q.put((t, peak_rss()))
+
+def measure(*args):
+    q = mp.Queue()
+    p = mp.Process(target=run, args=(q,)+args)
+    p.start()
+    t, rss = q.get()
+    p.join()
+    return t, rss
+
+
+if __name__ == '__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 's:m:f:l:j:po:c:')
+    if args:
+        print('Use: CSObench.py [-s MB] [-m Z:T:R] [-f KB,...] [-l N,...] [-j N,...] [-p] [-o JSON] [-c JSON]\n')
+        print('  -s MB      size of the synthetic ISO (default: 32)')
+        print('  -m Z:T:R   weights of zero, text-like and random sectors (default: 1:2:1)')
+        print('  -f KB,...  frame sizes (default: 2,4,8,16,32)')
+        print('  -l N,...   compression levels (default: 1,6,9)')
+        print('  -j N,...   thread counts, 1 = serial (default: 1 and one per CPU)')
+        print('  -p         also run with the incompressibility prefilter')
+        print('  -o JSON    save results to a JSON file')
+        print('  -c JSON    compare speeds with results saved from another revision')
+        sys.exit(1)
+
+    size = 32<<20
+    mix = (1,2,1)
+    frame_sizes = [2<<10, 4<<10, 8<<10, 16<<10, 32<<10]
+    levels = [1,6,9]
+    jobs = sorted({1, os.cpu_count()})
+    prefilters = [False]
+    outname = compare = None
+    for o, a in opts:
+        if o == '-s':
+            size = int(a)<<20
+        if o == '-m':
+            mix = tuple(int(w) for w in a.split(':'))
+        if o == '-f':
+            frame_sizes = [int(n)<<10 for n in a.split(',')]
+        if o == '-l':
+            levels = [int(n) for n in a.split(',')]
+        if o == '-j':
+            jobs = [int(n) or os.cpu_count() for n in a.split(',')]
+        if o == '-p':
+            prefilters = [False, True]
+        if o == '-o':
+            outname = a
+        if o == '-c':
+            compare = {(r['op'], r['frame'], r['level'], r['jobs'], r['prefilter']): r for r in json.load(open(a))['results']}
+
+    tmp = tempfile.mkdtemp()
+    iso = os.path.join(tmp, 'bench.iso')
+    cso = os.path.join(tmp, 'bench.cso')
+    make_iso(iso, size, mix)
+    print('Synthetic ISO of %d MB, zero:text:random sectors = %d:%d:%d, %d CPU(s)' % (size>>20, *mix, os.cpu_count()))
+    print('%-3s %6s %5s %4s %4s %9s %8s %7s %s' % ('op', 'frame', 'level', 'jobs', 'pre', 'MB/s', 'RSS MB', 'ratio', 'vs. other' if compare else ''))
+
+    results = []
+    def report(r):
+        results.append(r)
+        rss = '%8.1f' % r['rss_mb'] if r['rss_mb'] else '%8s' % '-'
+        other = ''
+        if compare:
+            o = compare.get((r['op'], r['frame'], r['level'], r['jobs'], r['prefilter']))
+            if o: other = '%+.1f%%' % ((r['mb_s']/o['mb_s']-1)*100)
+        print('%-3s %6d %5d %4d %4s %9.2f %s %6.2f%% %s' % (r['op'], r['frame'], r['level'], r['jobs'], 'yes' if r['prefilter'] else 'no', r['mb_s'], rss, r['ratio'], other))
+
+    try:
+        for frame_size in frame_sizes:
+            for level in levels:
+                for prefilter in prefilters:
+                    for j in jobs:
+                        t, rss = measure('c', iso, cso, frame_size, level, j, prefilter)
+                        ratio = os.path.getsize(cso) / size * 100
+                        report(dict(op='c', frame=frame_size, level=level, jobs=j, prefilter=prefilter, seconds=t, mb_s=size/t/(1<<20), rss_mb=rss, ratio=ratio))
+                    for j in jobs:
+                        t, rss = measure('d', iso, cso, frame_size, level, j, prefilter)
+                        report(dict(op='d', frame=frame_size, level=level, jobs=j, prefilter=prefilter, seconds=t, mb_s=size/t/(1<<20), rss_mb=rss, ratio=ratio))
+    finally:
+        for name in (iso, iso+'.out', cso):
+            if os.path.exists(name): os.remove(name)
+        os.rmdir(tmp)
+
+    if outname:
+        json.dump(dict(python=platform.python_version(), machine=platform.machine(), cpus=os.cpu_count(),
+            iso_mb=size>>20, mix=mix, results=results), open(outname, 'w'), indent=1)
@@ -1,87 +1,598 @@
 # A simple ISO to CSO v1 compressor for the PPSSPP Playstation Portable emulator
-import zlib, sys, struct
+import zlib, sys, struct, getopt, os, time, mmap, io
+from array import array
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor, Future
+from CSOd import read_header, read_index, read_frames, inflate, digest, read_manifest, write_manifest, DIGEST_SIZE, Stats, CSOFile
 #from zopfli import ZopfliCompressor
 
 def b2mb(n): return n / (1<<20)
 
-if len(sys.argv) < 2:
-    print('ERROR: a source ISO input image MUST be specified!')
-    print('Use: CSOc.py <ISO file> [[CSO file] level]\n')
-    print('Defaults: CSO goes to same path of input, with best compression.')
-    sys.exit(1)
-
 # Default unit compression size is 2K (like an ISO block)
 # Incrementing up to the maximum of 32K slightly improves compression:
 # this is supported by PPSSPP emulator
-frame_size = 8<<10
-
-if len(sys.argv) > 3:
-    level = int(sys.argv[3])
-else:
-    level = 9
-
-iso = open(sys.argv[1], 'rb')
-iso.seek(0, 2)
-iso_size = iso.tell()
-iso.seek(0)
-
-if len(sys.argv) > 2:
-    outname = sys.argv[2]
-else:
-    outname = sys.argv[1][:-3] + 'cso'
-
-print('Compressing a %.02f MB ISO (with a %d bytes frame) to "%s"' % (b2mb(iso_size),frame_size,outname))
-
-out = open(outname, 'w+b')
-out.seek(0)
-
-out.write(b'CISO') # magic tag
-out.write(struct.pack('<l',24)) # header size (ignored by decompressor)
-out.write(struct.pack('<q',iso_size)) # ISO size
-out.write(struct.pack('<l',frame_size)) # sector size (min 2048 bytes, max 32768)
-out.write(struct.pack('<l',1)) # compression type (only 1=ZIP is supported!)
-
-out.seek(24 + 4*(1+iso_size//frame_size)-1) # offset of first compressed block
-out.write(b'\x00')
-
-buf = 1
-CHUNK_SIZE = 64
-i = 0
-beg = 0
-while buf:
-    buf = iso.read(frame_size*CHUNK_SIZE)
-    if not buf: break
-    chunks = b''
-    sizes=[]
-    for chunk in range(len(buf)//frame_size):
-        sub = buf[chunk*frame_size : chunk*frame_size+frame_size]
-        cobj = zlib.compressobj(level, zlib.DEFLATED, -15)
-        z = cobj.compress(sub) + cobj.flush(zlib.Z_FINISH)
-        # cobj = ZopfliCompressor(iterations=3)
-        # z = cobj.compress(sub) + cobj.flush()
-        if len(z) < frame_size:
-            chunks += z
-            sizes += [len(z)]
-        else:
-            chunks += sub
-            sizes += [frame_size]
+FRAME_SIZE = 8<<10
+CHUNK_SIZE = 64 # frames read and written at a time
+AHEAD = 4 # chunks kept in flight when compressing with a pool
+STREAM_RESERVE = 2<<30 # ISO bytes the index has initially room for, when the ISO size is unknown
+STREAM_MAX = 8<<30 # largest ISO the default alignment must address, when its size is unknown (dual layer DVD)
+MOVE_SIZE = 1<<20 # bytes moved at a time, when the index has to grow
+# Auto tuning compresses some regions spread across the ISO with all these settings
+AUTO_FRAMES = (2<<10, 4<<10, 8<<10, 16<<10, 32<<10)
+AUTO_LEVELS = (1, 3, 6, 9)
+AUTO_REGIONS = 16
+AUTO_REGION_SIZE = 256<<10
+# A frame is taken for compressed or encrypted data if 256 bytes sampled in
+# each of its quarters show at least 145 different values (random data shows
+# 162 of them on average, text and code far less)
+SAMPLE_SIZE = 256
+SAMPLE_DISTINCT = 145
+
+_zeros = {} # (frame size, level): (zero frame, its deflated form)
+
+def same(a, b):
+    "Compare frames at memcmp speed, even if 'b' is a memoryview (a plain == compares it byte by byte)"
+    return len(a) == len(b) and bytes(a).startswith(b)
+
+def incompressible(sub):
+    "Guess if a frame would not shrink, looking at the byte values of some samples"
+    q = len(sub)//4
+    for k in range(4):
+        mid = k*q + q//2 - SAMPLE_SIZE//2
+        if len(set(bytes(sub[mid : mid+SAMPLE_SIZE]))) < SAMPLE_DISTINCT:
+            return False
+    return True
+
+def raw_deflate(data, level):
+    "Compress 'data' as a raw deflate stream"
+    cobj = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return cobj.compress(data) + cobj.flush(zlib.Z_FINISH)
+
+def deflate(sub, level, prefilter=False):
+    """Compress a frame as a raw deflate stream, or return it unchanged if it does
+    not shrink. Return it with its uncompressed flag and the path taken: zero,
+    skipped (by the prefilter), stored or deflated"""
+    zero = _zeros.get((len(sub), level))
+    if not zero:
+        zero = _zeros[len(sub), level] = bytes(len(sub)), raw_deflate(bytes(len(sub)), level)
+    if same(zero[0], sub): # padding frames are deflated once
+        if len(zero[1]) < len(sub):
+            return zero[1], False, 'zero'
+        return sub, True, 'stored'
+    if prefilter and incompressible(sub):
+        return sub, True, 'skipped'
+    z = raw_deflate(sub, level)
+    # cobj = ZopfliCompressor(iterations=3)
+    # z = cobj.compress(sub) + cobj.flush()
+    if len(z) < len(sub):
+        return z, False, 'deflated'
+    return sub, True, 'stored'
+
+def recompress(sub, level, prefilter, z, stored):
+    "Keep the old compressed frame 'z' if it still expands to 'sub', else (or if damaged) deflate 'sub'"
+    old = inflate(z, stored, len(sub))
+    if old != None and same(old, sub):
+        return z, stored, 'reused'
+    return deflate(sub, level, prefilter)
+
+def timed(stats, fn, *args):
+    "Call 'fn', accounting its time to compression"
+    with stats.timer('compress'):
+        return fn(*args)
+
+def unpadded(z, stored, frame_size):
+    "Drop the alignment padding after a compressed frame 'z'"
+    if stored:
+        return z[:frame_size]
+    d = zlib.decompressobj(-15)
+    d.decompress(z)
+    if d.eof: # else damaged, kept as it is
+        return z[:len(z)-len(d.unused_data)]
+    return z
+
+def old_frames(cso, iso=None, manifest=None):
+    """Yield a (data, stored, ref) tuple for every frame of an old CSO file, so
+    compress can reuse unchanged frames. 'ref' is the digest of the frame from
+    a 'manifest' list, or the frame read from the old 'iso' file, or None if
+    the frame has to be expanded to compare it"""
+    cso.seek(0)
+    iso_size, frame_size, align = read_header(cso)
+    index = read_index(cso, iso_size, frame_size)
+    for i, (z, stored) in enumerate(read_frames(cso, index, align)):
+        if align:
+            z = unpadded(z, stored, frame_size)
+        ref = None
+        if manifest:
+            if i < len(manifest): ref = manifest[i]
+        elif iso:
+            ref = iso.read(frame_size)
+        yield z, stored, ref
+
+def shifted(offset, align):
+    "Get an offset as stored in the index"
+    n = offset >> align
+    if n > 0x7FFFFFFF:
+        raise ValueError('CSO bigger than %d MB, a larger alignment is needed!' % (0x80000000 >> 20 << align))
+    return n
+
+def write_header(out, iso_size, frame_size, align):
+    "Write a CSO v1 header at the start of 'out'"
+    out.seek(0)
+    out.write(b'CISO') # magic tag
+    out.write(struct.pack('<l',24)) # header size (ignored by decompressor)
+    out.write(struct.pack('<q',iso_size)) # ISO size
+    out.write(struct.pack('<l',frame_size)) # sector size (min 2048 bytes, max 32768)
+    out.write(struct.pack('<BBxx',1,align)) # version (only 1=ZIP is supported!) and index shift
+
+def write_at(out, pieces, offset):
+    "Write a list of buffers at 'offset', with a single gathering system call if possible"
+    if hasattr(os, 'pwritev'):
+        try:
+            fd = out.fileno()
+        except (AttributeError, io.UnsupportedOperation): # i.e. BytesIO
+            fd = None
+        if fd != None:
+            out.flush() # also drops any read buffer, that could become stale
+            n = os.pwritev(fd, pieces, offset)
+            if n == sum(map(len, pieces)): return
+            pieces = [memoryview(b''.join(pieces))[n:]] # short write: retry the rest
+            offset += n
+    out.seek(offset)
+    out.write(b''.join(pieces))
+
+def min_align(iso_size, frame_size):
+    "Get the smallest index shift that can address a CSO for sure, whatever its compression ratio"
+    frames = iso_size//frame_size
+    align = 0
+    while (24 + 4*(1+frames) + frames*(frame_size + (1<<align)-1)) >> align > 0x7FFFFFFF:
+        align += 1
+    return align
+
+def resize_index(out, frames, data, end, room, align):
+    """Make room for exactly 'room' index entries (but the last), moving the
+    compressed frames between 'data' and 'end', and fixing the offsets of the
+    first 'frames' index entries. Return the new offset of the frames"""
+    pad = (1<<align) - 1
+    first = 24 + 4*(1+room)
+    delta = first + (-first & pad) - data
+    # move back to front when growing, front to back when shrinking, so
+    # nothing is overwritten before being moved
+    for pos in range(data, end, MOVE_SIZE)[::-1 if delta > 0 else 1]:
+        out.seek(pos)
+        buf = out.read(min(MOVE_SIZE, end-pos))
+        out.seek(pos+delta)
+        out.write(buf)
+    index = array('I')
+    out.seek(24)
+    index.frombytes(out.read(4*frames))
+    if sys.byteorder == 'big': index.byteswap()
+    for j, n in enumerate(index):
+        index[j] = (n & 0x80000000) | shifted(((n & 0x7FFFFFFF) << align) + delta, align)
+    if sys.byteorder == 'big': index.byteswap()
+    out.seek(24)
+    out.write(index.tobytes())
+    return data + delta
+
+def auto_tune(iso, iso_size, target='ratio', frames=AUTO_FRAMES, levels=AUTO_LEVELS, jobs=1, prefilter=False, align=0):
+    """Trial compress some regions of a seekable ISO with every frame size and
+    level, and pick the best setting for 'target':
+    'ratio[:S]'  the best ratio, compressing in no more than S seconds per GB
+    'read[:P]'   the smallest frame (the least read amplification), with a
+                 ratio no more than P% (default: 1) worse than the best one
+    Return frame size, level, projected CSO size and projected seconds"""
+    target, _, limit = target.partition(':')
+    if target not in ('ratio', 'read'):
+        raise ValueError('unknown auto tuning target "%s"!' % target)
+    regions = []
+    step = max(iso_size//AUTO_REGIONS, AUTO_REGION_SIZE)
+    for pos in range(0, iso_size, step):
+        iso.seek(pos - pos%max(AUTO_FRAMES))
+        regions += [iso.read(AUTO_REGION_SIZE)]
+    iso.seek(0)
+    sampled = sum(len(r) for r in regions)
+    trials = []
+    for frame_size in frames:
+        for level in levels:
+            size = 0
+            t = time.perf_counter()
+            for r in regions:
+                for j in range(len(r)//frame_size):
+                    z, stored, path = deflate(r[j*frame_size : j*frame_size+frame_size], level, prefilter)
+                    size += len(z) + (1<<align)//2 + 4 # frame, average padding and index entry
+                size += len(r)%frame_size
+            t = time.perf_counter() - t
+            trials += [(frame_size, level, size*iso_size/sampled, t*iso_size/sampled/jobs)]
+    if target == 'ratio':
+        fits = [x for x in trials if not limit or x[3]/iso_size*(1<<30) <= float(limit)]
+        if not fits: # the fastest one
+            return min(trials, key=lambda x: x[3])
+        return min(fits, key=lambda x: (x[2], x[3]))
+    best = min(x[2] for x in trials)
+    fits = [x for x in trials if x[2] <= best*(1+float(limit or 1)/100)]
+    return min(fits, key=lambda x: (x[0], x[3]))
+
+def compress(iso, out, iso_size, frame_size=FRAME_SIZE, level=9, pool=None, prefilter=False, align=0, reuse=None, digests=None, stats=None, verbose=True):
+    """Compress 'iso_size' bytes from file 'iso' to CSO file 'out', in frames of
+    'frame_size' bytes. If a 'pool' executor is given, chunks of frames are
+    compressed in parallel, but written in the same order (and with the same
+    result) of a serial run. With 'prefilter', frames that look incompressible
+    are stored without trying to deflate them. Frames start at multiples of
+    2^'align' bytes, and their offsets are stored shifted right by 'align' bits.
+    Frames equal to those from a 'reuse' iterator of old_frames are copied
+    without compressing them again. Frame digests are appended to the
+    'digests' list, if any.
+    If 'iso_size' is None, 'iso' is read up to its end (i.e. from a pipe): the
+    index grows as needed, and the header is fixed at the end.
+    A regular 'iso' file is mapped in memory, and frames are passed to zlib as
+    views of the map, without copying them. Pages of the frames already
+    written are released, so memory use does not grow with the ISO size.
+    Timings and counters are collected in 'stats', if given. Progress is shown if 'verbose'.
+    Return the CSO size and a Counter of the paths taken by frames"""
+    stream = iso_size == None
+    write_header(out, iso_size or 0, frame_size, align)
+
+    pad = (1<<align) - 1
+    room = (STREAM_RESERVE if stream else iso_size)//frame_size # index entries, but the last
+    first = 24 + 4*(1+room)
+    out.seek(first + (-first & pad) - 1) # offset of first compressed block
+    out.write(b'\x00')
+    nread = 0
+    view = None
+    if not stream:
+        try:
+            m = mmap.mmap(iso.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(m)
+            pos = start = iso.tell()
+            released = start // mmap.PAGESIZE * mmap.PAGESIZE
+        except (OSError, ValueError, io.UnsupportedOperation): # not a regular file, or empty
+            pass
+    idx = bytearray(4*CHUNK_SIZE) # index entries of a chunk, packed at once
+
+    def submit(fn, *args):
+        if stats: fn, args = timed, (stats, fn) + args
+        if pool: return pool.submit(fn, *args)
+        return fn(*args)
+
+    def read(n):
+        nonlocal pos
+        if view:
+            buf = view[pos : pos+n]
+            pos += len(buf)
+            return buf
+        if stats:
+            with stats.timer('read'):
+                return iso.read(n)
+        return iso.read(n)
+
+    def chunks():
+        "Split input in chunks of frames, compressed in background if a pool exists"
+        nonlocal nread
+        while True:
+            buf = read(frame_size*CHUNK_SIZE)
+            if not buf: break
+            nread += len(buf)
+            work = []
+            for j in range(len(buf)//frame_size):
+                sub = buf[j*frame_size : j*frame_size+frame_size]
+                h = None
+                if digests is not None:
+                    h = digest(sub)
+                    digests.append(h)
+                old = next(reuse, None) if reuse else None
+                if old:
+                    z, stored, ref = old
+                    if ref is None:
+                        work += [submit(recompress, sub, level, prefilter, z, stored)]
+                        continue
+                    if len(ref) == DIGEST_SIZE:
+                        match = ref == (h or digest(sub))
+                    else:
+                        match = same(ref, sub)
+                    if match:
+                        work += [(z, stored, 'reused')]
+                        continue
+                work += [submit(deflate, sub, level, prefilter)]
+            yield work
+
+    paths = Counter()
+    i = 0
+    beg = data = out.tell()
+    # keep some chunks in flight, so workers don't wait for the writer
+    pending = deque()
+    depth = AHEAD if pool else 0
+    it = chunks()
+    while True:
+        for chunk in it:
+            pending.append(chunk)
+            if len(pending) > depth: break
+        if not pending: break
+        frames = [f.result() if isinstance(f, Future) else f for f in pending.popleft()]
+        paths.update(path for z, stored, path in frames)
+        if i+len(frames) > room:
+            room = max(2*room, i+len(frames))
+            new = resize_index(out, i, data, beg, room, align)
+            beg, data = beg+new-data, new
+        t = time.perf_counter()
+        pieces = []
+        entries = []
+        for z, stored, path in frames:
+            n = shifted(beg, align)
+            if stored:
+                n |= 0x80000000 # uncompressed flag
+            entries += [n]
+            pieces += [z]
+            if -len(z) & pad:
+                pieces += [bytes(-len(z) & pad)]
+            beg += len(z) + (-len(z) & pad)
+        write_at(out, pieces, beg - sum(map(len, pieces))) # writes out sectors array, aligned
+        struct.pack_into('<%dL' % len(entries), idx, 0, *entries) # stores sector offsets
+        out.seek(24+i*4)
+        out.write(memoryview(idx)[:4*len(entries)])
+        i += len(frames)
+        if stats:
+            stats.add('write', time.perf_counter() - t)
+            for z, stored, path in frames:
+                stats.frame(frame_size, len(z), path)
+            stats.update()
+        if view and hasattr(mmap, 'MADV_DONTNEED'):
+            end = (start + i*frame_size) // mmap.PAGESIZE * mmap.PAGESIZE
+            if end > released: # pages of the frames written are read again from the ISO, if ever
+                m.madvise(mmap.MADV_DONTNEED, released, end-released)
+                released = end
+        if verbose:
+            sys.stdout.write('Written sector %d\r'%i)
+
+    if stream:
+        if 4*(room-i) > (beg-data)//64: # drop unused index room, if it's worth moving the frames
+            new = resize_index(out, i, data, beg, i, align)
+            beg, data = beg+new-data, new
+            out.truncate(beg)
+            out.seek(24+i*4)
+        out.write(struct.pack('<L',shifted(beg, align))) # stores next sector offset (virtual)
+        out.seek(8)
+        out.write(struct.pack('<q',nread)) # ISO size
+    else:
+        out.write(struct.pack('<L',shifted(beg, align))) # stores next sector offset (virtual)
+    out.seek(0,2)
+    return out.tell(), paths
+
+def copy_frames(cso, out, align=0, stats=None, verbose=True):
+    """Copy the compressed frames of CSO file 'cso' to CSO file 'out' as they
+    are, aligning them to 2^'align' bytes. Return the CSO size and a Counter of
+    the paths taken by frames"""
+    cso.seek(0)
+    iso_size, frame_size, old_align = read_header(cso)
+    index = read_index(cso, iso_size, frame_size)
+    write_header(out, iso_size, frame_size, align)
+    pad = (1<<align) - 1
+    first = 24 + 4*len(index)
+    beg = first + (-first & pad) # offset of first compressed block
+    entries = array('I')
+    pieces = []
+    paths = Counter()
+    t = time.perf_counter()
+    for z, stored in read_frames(cso, index, old_align):
+        n = shifted(beg, align)
+        if old_align:
+            z = unpadded(z, stored, frame_size)
+        if stored:
+            n |= 0x80000000 # uncompressed flag
+        entries.append(n)
+        pieces += [z, bytes(-len(z) & pad)]
+        beg += len(z) + (-len(z) & pad)
+        paths['copied'] += 1
+        if stats: stats.frame(frame_size, len(z), 'copied')
+        if len(entries) % CHUNK_SIZE == 0:
+            write_at(out, pieces, beg - sum(map(len, pieces)))
+            pieces = []
+            if stats:
+                stats.add('write', time.perf_counter() - t)
+                stats.update()
+                t = time.perf_counter()
+            if verbose:
+                sys.stdout.write('Copied sector %d\r'%len(entries))
+    write_at(out, pieces, beg - sum(map(len, pieces)))
+    entries.append(shifted(beg, align)) # stores next sector offset (virtual)
+    if sys.byteorder == 'big':
+        entries.byteswap()
+    out.seek(24)
+    out.write(entries)
+    if stats: stats.add('write', time.perf_counter() - t)
     out.seek(0,2)
-    beg = out.tell()
-    out.write(chunks) # writes out sectors array
-    out.seek(24+i*4)
-    for size in sizes:
-        n=beg
-        if size == frame_size:
-            n = beg|0x80000000 # uncompressed flag
-        out.write(struct.pack('<L',n)) # stores sector offset
-        beg += size
-    i += len(sizes)
-    sys.stdout.write('Written sector %d\r'%i)
-
-out.write(struct.pack('<L',beg)) # stores next sector offset (virtual)
-out.seek(0,2)
-size = out.tell()
-out.close()
-gain = 100.0 - size/float(iso_size)*100
-
-print('\nOK. Size reduced by %.02f%% to %.02f MB.' % (gain, b2mb(size)))
+    return out.tell(), paths
+
+def transcode(cso, out, frame_size=None, level=None, pool=None, prefilter=False, align=None, stats=None, verbose=True):
+    """Convert CSO file 'cso' to CSO file 'out', with a new 'frame_size' and
+    compression 'level', without an intermediate ISO: frames are expanded one
+    at a time, re-blocked and compressed again. If neither is given (or they
+    match those of the source), compressed frames are copied as they are.
+    Frames start at multiples of 2^'align' bytes (default: the least needed).
+    Return the CSO size and a Counter of the paths taken by frames"""
+    cso.seek(0)
+    iso = CSOFile(cso, cache=2) # only the frames of the current read
+    frame_size = frame_size or iso.frame_size
+    if align == None:
+        align = min_align(iso.size, frame_size)
+    if frame_size == iso.frame_size and level == None:
+        return copy_frames(cso, out, align, stats, verbose)
+    return compress(iso, out, iso.size, frame_size, 9 if level == None else level, pool, prefilter, align, stats=stats, verbose=verbose)
+
+
+if __name__ == '__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 'a:f:j:pmr:o:S:T:', ['auto='])
+    if not args:
+        print('ERROR: a source ISO input image MUST be specified!')
+        print('Use: CSOc.py [-a N] [-f KB] [-j N] [-p] [-m] [-r CSO [-o ISO]] [-S JSON [-T S]] [--auto=TARGET] <ISO file> [[CSO file] level]\n')
+        print('Defaults: CSO goes to same path of input, with best compression.')
+        print('An ISO file "-" is read from standard input, and needs a CSO file.')
+        print('A CSO given as input is transcoded to the new CSO file, with the new frame')
+        print('size and/or level; without both, its compressed frames are copied as they are.')
+        print('  -a N    align frames to 2^N bytes (default: the least needed by the ISO size, or by %d GB from standard input)' % (STREAM_MAX>>30))
+        print('  -f KB   frame size, from 2 to 32 KB (default: 8)')
+        print('  -j N    compress with N parallel threads (0 = one per CPU)')
+        print('  -p      store frames that look incompressible without deflating them')
+        print('  -m      save a manifest of frame digests to <CSO file>.hash')
+        print('  -r CSO  reuse the unchanged frames of a previous CSO, found with its .hash')
+        print('          manifest or by expanding them')
+        print('  -o ISO  with -r, find unchanged frames comparing with the previous ISO')
+        print('  -S JSON save timings and counters to a JSON file (- = print to stderr)')
+        print('  -T S    with -S, emit running stats every S seconds')
+        print('  --auto=TARGET  choose frame size and level (unless given) sampling the ISO:')
+        print('          ratio[:S]  best ratio, within S seconds per GB if given')
+        print('          read[:P]   smallest frame, within P% (default: 1) of the best ratio')
+        sys.exit(1)
+
+    jobs = 1
+    prefilter = False
+    align = None
+    manifest = False
+    oldname = oldiso = auto = None
+    frame_size = statsname = None
+    tick = 0
+    for o, a in opts:
+        if o == '-S':
+            statsname = a
+        if o == '-T':
+            tick = float(a)
+        if o == '-f':
+            frame_size = int(a)<<10
+        if o == '--auto':
+            auto = a
+        if o == '-m':
+            manifest = True
+        if o == '-r':
+            oldname = a
+        if o == '-o':
+            oldiso = open(a, 'rb')
+        if o == '-a':
+            align = int(a)
+        if o == '-j':
+            jobs = int(a) or os.cpu_count()
+        if o == '-p':
+            prefilter = True
+
+    if frame_size and (frame_size & (frame_size-1) or not 2048 <= frame_size <= 32768):
+        print('ERROR: frame size must be 2, 4, 8, 16 or 32 KB!')
+        sys.exit(1)
+
+    if len(args) > 2:
+        level = int(args[2])
+    else:
+        level = None
+
+    source = False
+    if args[0] == '-':
+        if len(args) < 2:
+            print('ERROR: a CSO output file MUST be specified, when reading from standard input!')
+            sys.exit(1)
+        iso = sys.stdin.buffer
+        iso_size = None # found at the end
+    else:
+        iso = open(args[0], 'rb')
+        source = iso.read(4) == b'CISO' # transcode a CSO
+        iso.seek(0, 2)
+        iso_size = iso.tell()
+        iso.seek(0)
+
+    if len(args) > 1:
+        outname = args[1]
+    else:
+        outname = args[0][:-3] + 'cso'
+
+    if source:
+        if len(args) < 2 or os.path.abspath(args[0]) == os.path.abspath(outname):
+            print('ERROR: a different CSO output file MUST be specified, when transcoding a CSO!')
+            sys.exit(1)
+        if oldname or manifest or auto:
+            print('ERROR: -r, -m and --auto need an ISO file!')
+            sys.exit(1)
+        try:
+            iso_size, fs, a = read_header(iso)
+        except ValueError as e:
+            print('ERROR:', e)
+            sys.exit(1)
+        if frame_size and iso_size//fs*fs % frame_size:
+            print('WARNING: the last %d bytes of the ISO don\'t fill a frame, and will be dropped!' % (iso_size//fs*fs % frame_size))
+
+    reuse = None
+    if oldname:
+        if os.path.abspath(oldname) == os.path.abspath(outname):
+            print('ERROR: the previous CSO can\'t be overwritten!')
+            sys.exit(1)
+        old = open(oldname, 'rb')
+        old_iso_size, old_size, old_align = read_header(old) # reused frames must have the same size
+        if frame_size and frame_size != old_size:
+            print('ERROR: the previous CSO has a different frame size!')
+            sys.exit(1)
+        frame_size = old_size
+        hashes = None
+        if os.path.exists(oldname+'.hash'):
+            fs, hashes = read_manifest(oldname+'.hash')
+            # a manifest left from an earlier build of the old CSO doesn't describe its frames
+            if fs != frame_size or len(hashes) != old_iso_size//frame_size or os.path.getmtime(oldname+'.hash') < os.path.getmtime(oldname):
+                print('WARNING: ignoring the stale manifest "%s"' % (oldname+'.hash'))
+                hashes = None
+        if hashes:
+            print('Reusing frames of "%s", by its manifest' % oldname)
+        elif oldiso:
+            print('Reusing frames of "%s", by comparison with the previous ISO' % oldname)
+        else:
+            print('Reusing frames of "%s", by expanding them' % oldname)
+        reuse = old_frames(old, oldiso, hashes)
+
+    if auto:
+        if iso_size == None:
+            print('ERROR: auto tuning needs an ISO file!')
+            sys.exit(1)
+        print('Sampling the ISO to choose frame size and level...')
+        try:
+            frame_size, level, projected, seconds = auto_tune(iso, iso_size, auto,
+                [frame_size] if frame_size else AUTO_FRAMES, AUTO_LEVELS if level == None else [level],
+                jobs, prefilter, align or 0)
+        except ValueError as e:
+            print('ERROR:', e)
+            sys.exit(1)
+        print('Chosen a %d bytes frame and level %d: projected %.02f MB (%.02f%% smaller) in %.1f second(s)' % (frame_size, level, b2mb(projected), 100.0 - projected/iso_size*100, seconds))
+
+    if not source: # else, the transcoder keeps the CSO ones
+        frame_size = frame_size or FRAME_SIZE
+        if level == None: level = 9
+        if align == None:
+            align = min_align(STREAM_MAX if iso_size == None else iso_size, frame_size)
+
+    if source:
+        print('Transcoding a CSO of a %.02f MB ISO to "%s"' % (b2mb(iso_size),outname))
+    elif iso_size == None:
+        print('Compressing an ISO from standard input (with a %d bytes frame) to "%s"' % (frame_size,outname))
+    else:
+        print('Compressing a %.02f MB ISO (with a %d bytes frame) to "%s"' % (b2mb(iso_size),frame_size,outname))
+
+    out = open(outname, 'w+b')
+    pool = None
+    if jobs > 1:
+        pool = ThreadPoolExecutor(jobs) # zlib releases the GIL while compressing
+    digests = [] if manifest else None
+    stats = Stats(statsname, tick) if statsname else None
+    try:
+        if source:
+            size, paths = transcode(iso, out, frame_size, level, pool, prefilter, align, stats)
+        else:
+            size, paths = compress(iso, out, iso_size, frame_size, level, pool, prefilter, align, reuse, digests, stats)
+    except ValueError as e: # the CSO outgrew the alignment
+        print('\nERROR: %s Pass a bigger one with -a.' % e)
+        sys.exit(1)
+    if pool: pool.shutdown()
+    out.close()
+    if stats: stats.emit()
+    if manifest:
+        write_manifest(outname+'.hash', frame_size, digests)
+    if iso_size == None:
+        iso_size = read_header(open(outname, 'rb'))[0]
+    gain = 100.0 - size/float(iso_size)*100
+
+    print('\nOK. Size reduced by %.02f%% to %.02f MB.' % (gain, b2mb(size)))
+    print('Frames: %d deflated, %d stored, %d skipped as incompressible, %d zero.' % (paths['deflated'], paths['stored'], paths['skipped'], paths['zero']))
+    if reuse:
+        print('Frames: %d reused from "%s".' % (paths['reused'], oldname))
+    if paths['copied']:
+        print('Frames: %d copied as they are.' % paths['copied'])
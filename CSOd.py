@@ -1,60 +1,549 @@
 # A simple CSO to ISO decompressor for the PPSSPP Playstation Portable emulator
-import zlib, sys, struct
-
-if len(sys.argv) < 2:
-    print('ERROR: a compressed CSO input image MUST be specified!')
-    sys.exit(1)
-
-cso = open(sys.argv[1], 'rb')
-
-if b'CISO' != cso.read(4):
-    print('ERROR: not a CSO compressed ISO image!')
-    sys.exit(1)
-
-cso.read(4) # header size (ignored)
-
-iso_size = struct.unpack('<Q', cso.read(8))[0] # uncompressed ISO size
-frame_size = struct.unpack('<L', cso.read(4))[0] # sector size (0x0800 = 2048)
-compressor = struct.unpack('<L', cso.read(4))[0] # compression (0=none,1=zip,2=bzip2,3=lzma)
-
-if compressor != 1:
-    print('ERROR: only ZIP compression is supported, unknown method %d!'%compressor)
-    sys.exit(1)
-if frame_size<2048 or frame_size>32768:
-    print('ERROR: only ZIP compression is supported, bad frame size %d!'%frame_size)
-    sys.exit(1)
-
-if len(sys.argv) > 2:
-    outname = sys.argv[2]
-else:
-    outname = sys.argv[1][:-3] + 'iso'
-
-print('Decompressing CSO image (with a %d bytes frame) to "%s"' % (frame_size,outname))
-
-out = open(outname, 'wb')
-i = 0
-for block in range(iso_size//frame_size):
-    cso.seek(24 + block*4)
-    DW1 = struct.unpack('<L', cso.read(4))[0] # offset of compressed block
-    DW2 = struct.unpack('<L', cso.read(4))[0] # offset of next compressed block
-    begin = DW1 & 0x7FFFFFFF
-    end = DW2 & 0x7FFFFFFF
-    cso.seek(begin)
-    z = cso.read(end-begin) # current block
-    if not (DW1 & 0x80000000):
+import zlib, sys, struct, io, os, getopt, threading, time, json
+from array import array
+from hashlib import blake2b
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+READ_SIZE = 1<<20 # bytes of compressed frames read at a time
+BATCH_SIZE = 64 # frames expanded by a worker at a time
+AHEAD = 16 # batches in flight when expanding with a pool
+DIGEST_SIZE = 16 # bytes of a frame digest in a manifest
+ZERO_SIZE = 1<<10 # longest compressed frame looked up among the known zero ones
+
+_zeros = {} # frame size: (zero frame, set of its compressed forms seen so far)
+
+class Stats:
+    """Timings and counters of a CSO conversion, saved as JSON to file 'name'
+    (or printed to stderr, if it is '-') at the end and every 'tick' seconds"""
+    def __init__ (p, name='-', tick=0):
+        p.name = name
+        p.tick = tick
+        p.times = Counter() # seconds spent reading, (de)compressing and writing
+        p.frames = Counter() # frames by path taken
+        p.ratios = Counter() # frames by compressed size, in 10% steps of a frame
+        p.bytes_in = p.bytes_out = 0 # ISO and CSO bytes
+        p.bad = 0
+        p._lock = threading.Lock()
+        p._start = p._last = time.perf_counter()
+
+    @contextmanager
+    def timer(p, phase):
+        "Account the time spent in a 'with' block to 'phase' (also from threads)"
+        t = time.perf_counter()
         try:
-            s = zlib.decompress(z, -15)
+            yield
+        finally:
+            p.add(phase, time.perf_counter() - t)
+
+    def add(p, phase, seconds):
+        "Account some seconds to 'phase' (also from threads)"
+        with p._lock:
+            p.times[phase] += seconds
+
+    def timed(p, phase, it):
+        "Account the time spent producing each item of iterator 'it' to 'phase'"
+        it = iter(it)
+        while True:
+            with p.timer(phase):
+                item = next(it, p)
+            if item is p: return
+            yield item
+
+    def frame(p, size, zsize, path):
+        "Count a frame of 'size' bytes taking 'zsize' bytes in the CSO"
+        p.frames[path] += 1
+        p.ratios[min(zsize*10//size, 10)*10] += 1
+        p.bytes_in += size
+        p.bytes_out += zsize
+
+    def as_dict(p, final=True):
+        elapsed = time.perf_counter() - p._start
+        return dict(final=final, seconds=round(elapsed, 3),
+            mb_s=round(p.bytes_in/(1<<20)/elapsed, 2) if elapsed else 0,
+            iso_bytes=p.bytes_in, cso_bytes=p.bytes_out,
+            times={k: round(v, 3) for k, v in p.times.items()},
+            frames=dict(p.frames), bad_blocks=p.bad,
+            # i.e. "30%": frames compressed to 30-40% of their size, "100%": stored ones
+            ratio_histogram={'%d%%' % k: p.ratios[k] for k in sorted(p.ratios)})
+
+    def emit(p, final=True):
+        s = json.dumps(p.as_dict(final))
+        if p.name == '-':
+            print(s, file=sys.stderr)
+        else:
+            with open(p.name, 'w') as f:
+                f.write(s)
+
+    def update(p):
+        "Emit running stats if a tick has passed"
+        if p.tick and time.perf_counter() - p._last >= p.tick:
+            p._last = time.perf_counter()
+            p.emit(False)
+
+def read_header(cso):
+    "Check a CSO header and return ISO size, frame size and index shift"
+    if b'CISO' != cso.read(4):
+        raise ValueError('not a CSO compressed ISO image!')
+
+    cso.read(4) # header size (ignored)
+
+    iso_size = struct.unpack('<Q', cso.read(8))[0] # uncompressed ISO size
+    frame_size = struct.unpack('<L', cso.read(4))[0] # sector size (0x0800 = 2048)
+    version, align = struct.unpack('<BBxx', cso.read(4)) # version (1=zip) and index shift (frames alignment)
+
+    if version != 1:
+        raise ValueError('only ZIP compression is supported, unknown method %d!'%version)
+    if frame_size<2048 or frame_size>32768:
+        raise ValueError('only ZIP compression is supported, bad frame size %d!'%frame_size)
+    return iso_size, frame_size, align
+
+def read_index(cso, iso_size, frame_size):
+    "Load the whole table of frame offsets, plus the virtual one past the last frame"
+    index = array('I')
+    cso.seek(24)
+    index.frombytes(cso.read(4*(1+iso_size//frame_size)))
+    if sys.byteorder == 'big': index.byteswap() # offsets are LE DWORDs
+    return index
+
+def read_frames(cso, index, align=0):
+    """Yield each frame as a (data, stored) tuple, reading compressed frames in
+    a single forward pass of large sequential chunks. Data of aligned frames
+    is followed by padding"""
+    buf = b''
+    base = 0 # file offset of buf
+    for block in range(len(index)-1):
+        DW1 = index[block] # offset of compressed block
+        begin = (DW1 & 0x7FFFFFFF) << align
+        end = (index[block+1] & 0x7FFFFFFF) << align # offset of next compressed block
+        if end > base+len(buf): # refill, keeping the unused tail
+            if not buf: cso.seek(begin)
+            buf = memoryview(bytes(buf[begin-base:]) + cso.read(max(READ_SIZE, end-begin)))
+            base = begin
+        yield buf[begin-base : end-base], DW1 & 0x80000000
+
+def digest(s):
+    "Get the digest of an uncompressed frame"
+    return blake2b(s, digest_size=DIGEST_SIZE).digest()
+
+def write_manifest(name, frame_size, digests):
+    "Save the digests of all uncompressed frames of an image to a manifest file"
+    with open(name, 'wb') as f:
+        f.write(b'CSOH') # magic tag
+        f.write(struct.pack('<LL', frame_size, len(digests)))
+        f.write(b''.join(digests))
+
+def read_manifest(name):
+    "Load a manifest, returning its frame size and the list of frame digests"
+    with open(name, 'rb') as f:
+        if b'CSOH' != f.read(4):
+            raise ValueError('not a CSO manifest!')
+        frame_size, n = struct.unpack('<LL', f.read(8))
+        data = f.read(n*DIGEST_SIZE)
+    if len(data) != n*DIGEST_SIZE:
+        raise ValueError('truncated CSO manifest!')
+    return frame_size, [data[i : i+DIGEST_SIZE] for i in range(0, len(data), DIGEST_SIZE)]
+
+def inflate(z, stored, frame_size):
+    "Expand a frame, or return None if it is damaged"
+    if stored: # was stored uncompressed
+        return z[:frame_size]
+    try:
+        return zlib.decompress(z, -15)
+    except zlib.error:
+        return None
+
+def inflate_sparse(z, stored, frame_size):
+    """Like inflate, but return an empty frame if it is all zeros. Small frames
+    already seen to expand to zeros are recognized without expanding them"""
+    zero = _zeros.get(frame_size)
+    if not zero:
+        zero = _zeros[frame_size] = bytes(frame_size), set()
+    small = not stored and len(z) <= ZERO_SIZE
+    if small and bytes(z) in zero[1]:
+        return b''
+    s = inflate(z, stored, frame_size)
+    if s is not None and len(s) == frame_size and zero[0].startswith(s):
+        if small:
+            zero[1].add(bytes(z))
+        return b''
+    return s
+
+def pwriter(out):
+    "Get a thread safe function to write data at some offset of file 'out'"
+    if hasattr(os, 'pwrite'):
+        fd = out.fileno()
+        def write(data, offset):
+            data = memoryview(data)
+            while data:
+                n = os.pwrite(fd, data, offset)
+                data, offset = data[n:], offset+n
+    else: # Windows
+        lock = threading.Lock()
+        def write(data, offset):
+            with lock:
+                out.seek(offset)
+                out.write(data)
+    return write
+
+def inflate_batch(write, first, frames, frame_size, stats=None, sparse=False):
+    """Expand consecutive frames starting from block 'first' and write them in place, returning the bad blocks.
+    If 'sparse', zero (and bad) frames are not written, leaving holes in the output"""
+    bad = []
+    runs = [(first, [])] # consecutive frames to write at once
+    t = time.perf_counter()
+    for i, (z, stored) in enumerate(frames):
+        s = inflate_sparse(z, stored, frame_size) if sparse else inflate(z, stored, frame_size)
+        if s is None:
+            bad += [first+i]
+            s = b'' if sparse else bytes(frame_size) # leave a hole of zeros
+        if s:
+            runs[-1][1].append(s)
+        elif runs[-1][1]:
+            runs += [(first+i+1, [])]
+        else:
+            runs[-1] = (first+i+1, [])
+    if stats:
+        stats.add('inflate', time.perf_counter() - t)
+    t = time.perf_counter()
+    for block, data in runs:
+        if data:
+            write(b''.join(data), block*frame_size)
+    if stats:
+        stats.add('write', time.perf_counter() - t)
+    return bad
+
+def decompress(cso, out, iso_size, frame_size, align=0, pool=None, stats=None, verbose=True, sparse=False):
+    """Expand frames from CSO file 'cso' to ISO file 'out', returning the list of bad blocks.
+    If a 'pool' executor is given, batches of frames are expanded in parallel
+    and written at their place in the preallocated output, in any order.
+    If 'sparse', zero frames are skipped over instead of written, so that the
+    file system can leave holes in the output.
+    Timings and counters are collected in 'stats', if given. Progress is shown if 'verbose'"""
+    index = read_index(cso, iso_size, frame_size)
+    frames = read_frames(cso, index, align)
+    if stats:
+        frames = stats.timed('read', frames)
+    if pool:
+        return decompress_parallel(cso, out, iso_size, frame_size, align, pool, index, frames, stats, verbose, sparse)
+    bad = []
+    expand = inflate_sparse if sparse else inflate
+    for i, (z, stored) in enumerate(frames):
+        if stats:
+            with stats.timer('inflate'):
+                s = expand(z, stored, frame_size)
+        else:
+            s = expand(z, stored, frame_size)
+        if s is None:
+            print('\nBad compressed block %d detected!' % i)
+            bad += [i]
+            s = b'' if sparse else bytes(frame_size) # zero filled, as in parallel mode
+        if not s:
+            out.seek(frame_size, 1) # leave a hole
+        elif stats:
+            with stats.timer('write'):
+                out.write(s)
+        else:
             out.write(s)
+        if stats:
+            stats.frame(frame_size, len(z), 'stored' if stored else 'deflated')
+            stats.bad = len(bad)
+            stats.update()
+        if verbose:
+            sys.stdout.write('Written block %d\r'%i)
+        if out.tell() >= iso_size: break
+    if sparse:
+        out.truncate() # sets the size, if the output ends with holes
+    return bad
+
+def decompress_parallel(cso, out, iso_size, frame_size, align, pool, index, frames, stats, verbose, sparse=False):
+    size = min(iso_size, (len(index)-1)*frame_size) # only whole frames are indexed
+    out.truncate(size)
+    if hasattr(os, 'posix_fallocate') and not sparse: # would fill the holes
+        try:
+            os.posix_fallocate(out.fileno(), 0, size)
+        except OSError: # i.e. unsupported by the file system
+            pass
+    write = pwriter(out)
+    bad = []
+    slots = threading.Semaphore(AHEAD) # bounds memory to AHEAD batches
+    def done(f):
+        slots.release()
+        if not f.exception():
+            for i in f.result():
+                print('\nBad compressed block %d detected!' % i)
+                bad.append(i)
+    batch = []
+    first = 0
+    futures = []
+    for i, frame in enumerate(frames):
+        batch += [frame]
+        if stats:
+            stats.frame(frame_size, len(frame[0]), 'stored' if frame[1] else 'deflated')
+            stats.bad = len(bad)
+            stats.update()
+        if len(batch) == BATCH_SIZE or i == len(index)-2:
+            slots.acquire()
+            f = pool.submit(inflate_batch, write, first, batch, frame_size, stats, sparse)
+            f.add_done_callback(done)
+            futures += [f]
+            first, batch = i+1, []
+            if verbose:
+                sys.stdout.write('Written block %d\r'%i)
+    for f in futures:
+        f.result() # raises any worker error
+    if stats:
+        stats.bad = len(bad)
+    return sorted(bad)
+
+def check_batch(first, frames, refs, frame_size):
+    """Compare consecutive frames starting from block 'first' with their
+    uncompressed frames or digests in 'refs', returning the bad blocks"""
+    bad = []
+    for i, (z, stored) in enumerate(frames):
+        s = inflate(z, stored, frame_size)
+        ref = refs[i] if i < len(refs) else None
+        if s is None or ref is None:
+            bad += [first+i]
+        elif len(ref) == DIGEST_SIZE:
+            if digest(s) != ref: bad += [first+i]
+        elif s != ref:
+            bad += [first+i]
+    return bad
+
+def verify(cso, iso_size, frame_size, align=0, iso=None, manifest=None, pool=None, stop=True):
+    """Check every frame of a CSO file against the same frame of an 'iso' file,
+    or against its digest from a 'manifest' list, without writing anything.
+    Return the list of damaged or different blocks: only the first one with
+    'stop', or all of them"""
+    index = read_index(cso, iso_size, frame_size)
+    bad = []
+    slots = threading.Semaphore(AHEAD)
+    def done(f):
+        slots.release()
+        if not f.exception():
+            bad.extend(f.result())
+    batch = []
+    first = 0
+    futures = []
+    for i, frame in enumerate(read_frames(cso, index, align)):
+        batch += [frame]
+        if len(batch) == BATCH_SIZE or i == len(index)-2:
+            if iso:
+                buf = iso.read(frame_size*len(batch)) # sequential as the CSO
+                refs = [buf[j*frame_size : j*frame_size+frame_size] for j in range(len(buf)//frame_size)]
+            else:
+                refs = manifest[first : i+1]
+            if pool:
+                slots.acquire()
+                f = pool.submit(check_batch, first, batch, refs, frame_size)
+                f.add_done_callback(done)
+                futures += [f]
+            else:
+                bad += check_batch(first, batch, refs, frame_size)
+            first, batch = i+1, []
+            sys.stdout.write('Checked block %d\r'%i)
+            if stop and bad: break
+    for f in futures:
+        f.result() # raises any worker error
+    bad.sort()
+    if stop: return bad[:1]
+    return bad
+
+class CSOFile(io.RawIOBase):
+    """Read-only file object over the ISO image inside a CSO, decoding only the
+    frames touched by a read and keeping the last 'cache' ones in a LRU cache.
+    I.e. to get the Primary Volume Descriptor:
+        with CSOFile('game.cso') as f:
+            f.seek(16*2048)
+            pvd = f.read(2048)"""
+    def __init__ (p, cso, cache=64):
+        super().__init__()
+        p._owned = isinstance(cso, str)
+        if p._owned:
+            cso = open(cso, 'rb')
+        p._cso = cso
+        try:
+            p.iso_size, p.frame_size, p.align = read_header(cso)
+            p._index = read_index(cso, p.iso_size, p.frame_size)
         except:
-            print('\nBad compressed block %d detected!' % i)
-    else: # was stored uncompressed
-        out.write(z)
-    sys.stdout.write('Written block %d\r'%i)
-    i+=1
-    if out.tell() >= iso_size: break
+            if p._owned: cso.close()
+            raise
+        # only whole frames are indexed
+        p.size = min(p.iso_size, (len(p._index)-1)*p.frame_size)
+        p.cache_size = max(1, cache)
+        p._cache = OrderedDict()
+        p._pos = 0
+
+    def readable(p): return True
+
+    def seekable(p): return True
+
+    def tell(p):
+        p._checkClosed()
+        return p._pos
+
+    def seek(p, offset, whence=io.SEEK_SET):
+        p._checkClosed()
+        if whence == io.SEEK_CUR:
+            offset += p._pos
+        elif whence == io.SEEK_END:
+            offset += p.size
+        elif whence != io.SEEK_SET:
+            raise ValueError('invalid whence %r' % whence)
+        if offset < 0:
+            raise ValueError('negative seek position %d' % offset)
+        p._pos = offset
+        return offset
+
+    def frame(p, block):
+        "Get the uncompressed frame number 'block'"
+        s = p._cache.get(block)
+        if s is not None:
+            p._cache.move_to_end(block)
+            return s
+        DW1 = p._index[block]
+        begin = (DW1 & 0x7FFFFFFF) << p.align
+        end = (p._index[block+1] & 0x7FFFFFFF) << p.align
+        p._cso.seek(begin)
+        s = p._cso.read(end-begin)
+        if DW1 & 0x80000000:
+            s = s[:p.frame_size] # drop alignment padding
+        else:
+            try:
+                s = zlib.decompress(s, -15)
+            except zlib.error:
+                raise OSError('bad compressed block %d' % block)
+        if len(s) != p.frame_size: # short frame, or truncated file
+            raise OSError('bad compressed block %d' % block)
+        p._cache[block] = s
+        if len(p._cache) > p.cache_size:
+            p._cache.popitem(last=False)
+        return s
+
+    def readinto(p, b):
+        p._checkClosed()
+        m = memoryview(b).cast('B')
+        n = max(0, min(len(m), p.size-p._pos))
+        i = 0
+        while i < n:
+            block, offs = divmod(p._pos+i, p.frame_size)
+            s = p.frame(block)[offs : offs+n-i]
+            m[i : i+len(s)] = s
+            i += len(s)
+        p._pos += n
+        return n
+
+    def close(p):
+        if not p.closed and p._owned:
+            p._cso.close()
+        super().close()
+
+
+if __name__ == '__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 'j:vc:m:asS:T:')
+    if not args:
+        print('ERROR: a compressed CSO input image MUST be specified!')
+        print('Use: CSOd.py [-j N] [-s] [-S JSON [-T S]] <CSO file> [ISO file]')
+        print('     CSOd.py [-j N] -v [-c ISO | -m HASH] [-a] <CSO file>\n')
+        print('  -j N     expand (or verify) with N parallel threads (0 = one per CPU)')
+        print('  -v       verify the CSO against its <CSO file>.hash manifest, writing nothing')
+        print('  -c ISO   verify the CSO against the ISO it came from')
+        print('  -m HASH  verify the CSO against a manifest of frame digests')
+        print('  -a       report all the bad blocks, instead of stopping at the first one')
+        print('  -s       leave zero blocks as holes of a sparse ISO, instead of writing them')
+        print('  -S JSON  save timings and counters to a JSON file (- = print to stderr)')
+        print('  -T S     with -S, emit running stats every S seconds')
+        sys.exit(1)
+
+    jobs = 1
+    verifying = False
+    stop = True
+    sparse = False
+    isoname = hashname = statsname = None
+    tick = 0
+    for o, a in opts:
+        if o == '-S':
+            statsname = a
+        if o == '-T':
+            tick = float(a)
+        if o == '-j':
+            jobs = int(a) or os.cpu_count()
+        if o == '-v':
+            verifying = True
+        if o == '-c':
+            verifying = True
+            isoname = a
+        if o == '-m':
+            verifying = True
+            hashname = a
+        if o == '-a':
+            stop = False
+        if o == '-s':
+            sparse = True
+
+    cso = open(args[0], 'rb')
+
+    try:
+        iso_size, frame_size, align = read_header(cso)
+    except ValueError as e:
+        print('ERROR:', e)
+        sys.exit(1)
+
+    if verifying:
+        iso = manifest = None
+        if isoname:
+            print('Verifying CSO image (with a %d bytes frame) against "%s"' % (frame_size,isoname))
+            iso = open(isoname, 'rb')
+            size = os.fstat(iso.fileno()).st_size
+            if size != iso_size:
+                print('ERROR: the ISO is %d bytes long, the CSO image %d!\nFAILED.' % (size, iso_size))
+                sys.exit(1)
+        else:
+            hashname = hashname or args[0]+'.hash'
+            print('Verifying CSO image (with a %d bytes frame) against "%s"' % (frame_size,hashname))
+            try:
+                fs, manifest = read_manifest(hashname)
+            except (OSError, ValueError) as e:
+                print('ERROR:', e)
+                sys.exit(1)
+            if fs != frame_size:
+                print('ERROR: manifest is for a %d bytes frame!' % fs)
+                sys.exit(1)
+            if len(manifest) != iso_size//frame_size:
+                print('ERROR: manifest has %d digests, the CSO image %d blocks!\nFAILED.' % (len(manifest), iso_size//frame_size))
+                sys.exit(1)
+        pool = None
+        if jobs > 1:
+            pool = ThreadPoolExecutor(jobs)
+        bad = verify(cso, iso_size, frame_size, align, iso, manifest, pool, stop)
+        if pool: pool.shutdown()
+        for i in bad:
+            print('\nBlock %d (ISO offset %d) does not match!' % (i, i*frame_size), end='')
+        if bad:
+            print('\nFAILED.')
+            sys.exit(1)
+        print('\nOK. All the %d blocks match.' % (iso_size//frame_size))
+        sys.exit(0)
+
+    if len(args) > 1:
+        outname = args[1]
+    else:
+        outname = args[0][:-3] + 'iso'
+
+    print('Decompressing CSO image (with a %d bytes frame) to "%s"' % (frame_size,outname))
 
-out.close()
-size = cso.tell()
-gain = float(iso_size)/size*100
+    out = open(outname, 'wb')
+    pool = None
+    if jobs > 1:
+        pool = ThreadPoolExecutor(jobs) # zlib releases the GIL while expanding
+    stats = Stats(statsname, tick) if statsname else None
+    decompress(cso, out, iso_size, frame_size, align, pool, stats, sparse=sparse)
+    if pool: pool.shutdown()
+    out.close()
+    if stats: stats.emit()
+    size = cso.seek(0, 2)
+    gain = float(iso_size)/size*100
 
-print('\nOK. Size expanded by %.02f%% from %d to %d bytes.' % (gain, size, iso_size))
+    print('\nOK. Size expanded by %.02f%% from %d to %d bytes.' % (gain, size, iso_size))
@@ -1,5 +1,6 @@
 from tkinter import *
 from tkinter.ttk import *
+import time
 from myOTP import clock
 
 root = Tk()
@@ -7,9 +8,19 @@ root.title('NTP Offset')
 
 def display():
     lbl.config(text='%f s'%clock.offset)
+    info.config(text='drift %+.3f ppm, jitter %.3f ms, next poll in %d s' % (clock.drift*1e6, clock.jitter*1e3, clock.poll))
+    rows = ['%s  %-20s %+10.3f ms %8.3f ms %+9.3f ms' % (time.strftime('%H:%M:%S', time.localtime(t)), server, offset*1e3, delay*1e3, jitter*1e3)
+        for t, server, offset, delay, jitter in list(clock.samples)[-10:]]
+    samples.config(text='\n'.join(['%-8s  %-20s %13s %11s %12s' % ('time', 'server', 'offset', 'delay', 'jitter')] + rows))
+    lbl.after(1000, display)
 
 lbl = Label(root, font=('calibri', 40, 'bold'), background='purple', foreground='white')
 lbl.pack(anchor='center')
+info = Label(root, font=('calibri', 12))
+info.pack(anchor='center')
+samples = Label(root, font=('courier', 9), justify='left')
+samples.pack(anchor='w')
+clock.start() # keeps the offset synchronized in background
 display()
  
 mainloop()
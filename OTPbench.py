@@ -0,0 +1,101 @@
+# Correctness gate and speed benchmark for HMAC, HOTP and TOTP of myOTP, run offline
+import sys, time, json, getopt, struct, hmac, random, platform
+import myOTP
+from myOTP import HMAC, HOTP, TOTP, OTPKey, HASHES
+
+# RFC 4226 appendix D: HOTP of a 20 bytes key, counters 0-9
+RFC4226 = ('755224', '287082', '359152', '969429', '338314', '254676', '287922', '162583', '399871', '520489')
+# RFC 6238 appendix B: TOTP of 8 digits, 30 s interval, at some Unix times
+RFC6238_KEYS = {'sha1': b'12345678901234567890', 'sha256': b'12345678901234567890123456789012',
+    'sha512': b'1234567890123456789012345678901234567890123456789012345678901234'}
+RFC6238 = {59: ('94287082', '46119246', '90693936'), 1111111109: ('07081804', '68084774', '25091201'),
+    1111111111: ('14050471', '67062674', '99943326'), 1234567890: ('89005924', '91819424', '93441116'),
+    2000000000: ('69279037', '90698825', '38618901'), 20000000000: ('65353130', '77737706', '47863826')}
+
+class FixedClock:
+    "A clock stopped at Unix time 'T', in place of the NTP one"
+    def __init__ (p, T): p.T = T
+    def time(p): return p.T
+
+def stdlib_hotp(k, c, d, h):
+    "HOTP on top of the stdlib hmac module, as a baseline"
+    b = hmac.digest(k, struct.pack('>Q', c), h)
+    i = b[-1] & 0xF
+    return ('%010d' % (struct.unpack_from('>I', b, i)[0] & 0x7FFFFFFF))[-d:]
+
+def gate():
+    "Check the RFC test vectors and HMAC against the stdlib. Return a list of failures"
+    failed = []
+    for c, code in enumerate(RFC4226):
+        if HOTP(RFC6238_KEYS['sha1'], c) != code:
+            failed += ['RFC 4226 HOTP counter %d' % c]
+    for T, codes in RFC6238.items():
+        myOTP.clock = FixedClock(T)
+        for (h, k), code in zip(RFC6238_KEYS.items(), codes):
+            if TOTP(k, 30, 8, h) != code:
+                failed += ['RFC 6238 TOTP %s at %d' % (h, T)]
+    r = random.Random(0)
+    for h in HASHES:
+        for n in (0, 1, 20, 63, 64, 65, 127, 128, 129, 200):
+            k, m = r.randbytes(n), r.randbytes(r.randrange(100))
+            if HMAC(k, m, HASHES[h]) != hmac.digest(k, m, h):
+                failed += ['HMAC %s with a %d bytes key' % (h, n)]
+    return failed
+
+def rate(fn, seconds):
+    "Get the calls per second of 'fn', called for about 'seconds'"
+    n, t = 0, 0.0
+    batch = 64
+    start = time.perf_counter()
+    while t < seconds:
+        for i in range(batch): fn(n+i)
+        n += batch
+        t = time.perf_counter() - start
+        batch *= 2
+    return n / t
+
+
+if __name__ == '__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 't:d:o:')
+    if args:
+        print('Use: OTPbench.py [-t S] [-d N,...] [-o JSON]\n')
+        print('Checks myOTP against the RFC 4226 and 6238 vectors, then measures codes per second.')
+        print('  -t S      seconds per case (default: 0.5)')
+        print('  -d N,...  digit counts (default: 6,8)')
+        print('  -o JSON   save results to a JSON file')
+        sys.exit(1)
+
+    seconds = 0.5
+    digits = [6, 8]
+    outname = None
+    for o, a in opts:
+        if o == '-t':
+            seconds = float(a)
+        if o == '-d':
+            digits = [int(n) for n in a.split(',')]
+        if o == '-o':
+            outname = a
+
+    failed = gate()
+    for f in failed:
+        print('FAILED:', f)
+    if failed:
+        sys.exit(1)
+    print('OK. RFC 4226 and 6238 vectors, and HMAC against the stdlib, all match.\n')
+
+    myOTP.clock = FixedClock(1234567890) # no NTP round while measuring
+    print('%-7s %6s %12s %12s %12s %12s %8s' % ('hash', 'digits', 'HOTP/s', 'OTPKey/s', 'TOTP/s', 'stdlib/s', 'vs. std'))
+    results = []
+    for h, k in RFC6238_KEYS.items():
+        key = OTPKey(k, h)
+        for d in digits:
+            r = dict(hash=h, digits=d,
+                hotp=rate(lambda c: HOTP(k, c, d, h), seconds),
+                otpkey=rate(lambda c: key.hotp(c, d), seconds),
+                totp=rate(lambda c: TOTP(key, 30, d), seconds),
+                stdlib=rate(lambda c: stdlib_hotp(k, c, d, h), seconds))
+            results.append(r)
+            print('%-7s %6d %12.0f %12.0f %12.0f %12.0f %+7.1f%%' % (h, d, r['hotp'], r['otpkey'], r['totp'], r['stdlib'], (r['otpkey']/r['stdlib']-1)*100))
+
+    if outname:
+        json.dump(dict(python=platform.python_version(), machine=platform.machine(), results=results), open(outname, 'w'), indent=1)
@@ -0,0 +1,104 @@
+# Load test for the myOTP server mode, with many concurrent connections
+import sys, os, time, json, getopt, random, asyncio, tempfile, subprocess, socket, base64
+from myOTP import SecretStore, OTPClient, split_address
+
+async def connection(address, requests, pipeline, latencies):
+    "Send 'requests' over a connection, keeping up to 'pipeline' of them in flight"
+    address = split_address(address)
+    if isinstance(address, tuple):
+        reader, writer = await asyncio.open_connection(*address)
+    else:
+        reader, writer = await asyncio.open_unix_connection(address)
+    sent = {} # request id: when sent
+    slots = asyncio.Semaphore(pipeline)
+    async def receive():
+        for i in range(len(requests)):
+            reply = json.loads(await reader.readline())
+            latencies.append(time.perf_counter() - sent.pop(reply['id']))
+            slots.release()
+    receiver = asyncio.create_task(receive())
+    for i, req in enumerate(requests):
+        await slots.acquire()
+        req['id'] = i
+        sent[i] = time.perf_counter()
+        writer.write(json.dumps(req).encode() + b'\n')
+        await writer.drain()
+    await receiver
+    writer.close()
+
+async def load(address, plan, pipeline):
+    latencies = []
+    t = time.perf_counter()
+    await asyncio.gather(*(connection(address, requests, pipeline, latencies) for requests in plan))
+    return time.perf_counter() - t, sorted(latencies)
+
+def wait_server(address, timeout=10):
+    "Wait until a server answers on 'address'"
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return OTPClient(address)
+        except OSError:
+            if time.monotonic() > deadline: raise
+            time.sleep(0.1)
+
+
+if __name__ == '__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 'c:n:p:u:')
+    if len(args) > 1:
+        print('Use: OTPload.py [-c N] [-n N] [-p N] [-u N] [ADDRESS]\n')
+        print('Sends generate and validate requests to a myOTP server. Without an ADDRESS,')
+        print('starts a local one with a temporary store of random users.')
+        print('  -c N  concurrent connections (default: 16)')
+        print('  -n N  requests in all (default: 20000)')
+        print('  -p N  requests in flight on each connection (default: 8)')
+        print('  -u N  users of the temporary store, or random keys sent (default: 1000)')
+        sys.exit(1)
+
+    conns, total, pipeline, users = 16, 20000, 8, 1000
+    for o, a in opts:
+        if o == '-c':
+            conns = int(a)
+        if o == '-n':
+            total = int(a)
+        if o == '-p':
+            pipeline = int(a)
+        if o == '-u':
+            users = int(a)
+
+    r = random.Random(0)
+    server = tmp = None
+    if args:
+        address = args[0]
+        # an external server knows no users: send the keys
+        keys = [base64.b32encode(r.randbytes(20)).decode() for i in range(users)]
+        who = lambda: {'key': r.choice(keys)}
+    else:
+        tmp = tempfile.mkdtemp()
+        store = os.path.join(tmp, 'users.bin')
+        SecretStore.build((uid, r.randbytes(20), 'sha1') for uid in range(users)).save(store)
+        address = os.path.join(tmp, 'otp.sock') if hasattr(socket, 'AF_UNIX') else '127.0.0.1:49123'
+        server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'myOTP.py'),
+            '-l', address, '-k', store], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        who = lambda: {'user': r.randrange(users)}
+
+    try:
+        client = wait_server(address)
+        before = client.stats()
+        plan = [[dict(op=r.choice(('generate', 'validate')), code='%06d' % r.randrange(10**6), **who())
+            for i in range(total//conns)] for c in range(conns)]
+        t, lat = asyncio.run(load(address, plan, pipeline))
+        after = client.stats()
+        client.close()
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+            for name in os.listdir(tmp): os.remove(os.path.join(tmp, name))
+            os.rmdir(tmp)
+
+    n = len(lat)
+    print('%d requests on %d connection(s), %d in flight each: %.2f s, %.0f requests/s' % (n, conns, pipeline, t, n/t))
+    print('Latency (ms): mean %.3f, p50 %.3f, p99 %.3f, max %.3f' % (sum(lat)/n*1e3, lat[n//2]*1e3, lat[n*99//100]*1e3, lat[-1]*1e3))
+    batches = after['batches'] - before['batches']
+    print('Server: %d batches, %.1f requests per batch, %d error(s)' % (batches, (after['requests'] - before['requests'])/batches if batches else 0, after['errors'] - before['errors']))
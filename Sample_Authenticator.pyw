@@ -1,29 +1,46 @@
 from tkinter import *
 from tkinter.ttk import *
-from time import strftime
-from myOTP import TOTPT
+from myOTP import Authenticator, clock
 from base64 import b32decode
 
 root = Tk()
 root.title('Sample TOTP Generator')
 
-k = b32decode('AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA') # base32 encoded shared secret
- 
-def display():
-    try:
-        totp, ss = TOTPT(k)
-    except:
-        root.destroy()
-    lbl.config(text=f'{totp}:{ss:02d}') # display current TOTP and seconds before it expires
-    lbl.after(1000, display)
-
-def on_click(e):
-    lbl.clipboard_clear()
-    lbl.clipboard_append(TOTPT(k)[0])
- 
-lbl = Label(root, font=('calibri', 40, 'bold'), background='purple', foreground='white')
-lbl.bind("<Button-1>", on_click) # click label to copy TOTP to clipboard
-lbl.pack(anchor='center')
-display()
- 
+auth = Authenticator()
+# name, base32 encoded shared secret, interval, digits, hash
+for name, k, TI, d, h in (('Sample', 'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA', 30, 6, 'sha1'),
+                          ('Sample (60 s, SHA-256)', 'GEZDGNBVGY3TQOJQGEZDGNBVGY3TQOJQ', 60, 8, 'sha256')):
+    auth.add(name, b32decode(k), TI, d, h)
+
+labels = {}
+codes = {} # name: (TOTP, expiration time)
+
+def refresh():
+    "Get the new codes, then sleep until the next one expires"
+    for name, totp, expires in auth.codes():
+        codes[name] = totp, expires
+    countdown()
+    root.after(int(auth.next_change()*1000) + 1, refresh)
+
+def countdown():
+    "Show the seconds left to every code, without computing them again"
+    now = clock.time()
+    for name, (totp, expires) in codes.items():
+        labels[name].config(text=f'{name}: {totp}:{expires-int(now):02d}') # display TOTP and seconds before it expires
+
+def tick():
+    countdown()
+    root.after(1000 - int(clock.time()*1000) % 1000, tick)
+
+def on_click(name):
+    root.clipboard_clear()
+    root.clipboard_append(codes[name][0])
+
+for name in auth.accounts:
+    lbl = labels[name] = Label(root, font=('calibri', 24, 'bold'), background='purple', foreground='white')
+    lbl.bind("<Button-1>", lambda e, name=name: on_click(name)) # click label to copy TOTP to clipboard
+    lbl.pack(anchor='center', fill='x')
+refresh()
+tick()
+
 mainloop()
@@ -1,10 +1,13 @@
 # -*- coding: windows-1252 -*-
 "Funzioni per il calcolo del codice fiscale italiano secondo il D.M. Finanze n.13813 del 23/12/1976 e della partita IVA"
-import json
 from difflib import SequenceMatcher
+from tabelle import tabella
 
-uffici = json.load(open('uffici.json'))
-territori = json.load(open('territori.json'))
+def __getattr__(nome):
+    "Carica le tabelle uffici e territori solo al primo accesso come attributi del modulo"
+    if nome in ('uffici', 'territori'):
+        return tabella(nome)
+    raise AttributeError(f"module {__name__!r} has no attribute {nome!r}")
 
 
 def islike(a, b):
@@ -20,6 +23,7 @@ def islike(a, b):
 def get_cod_comune(nome):
     "Ricava il codice catastale di 4 caratteri corrispondente a un comune o stato estero"
     nome = nome.upper()
+    territori = tabella('territori')
     r = []
     for o in territori:
         if nome == territori[o][0]: r += [o]
@@ -99,7 +103,7 @@ def get_dati_cf(cf):
         gg-=40
     else:
         sesso = 'M'
-    return sesso, territori[cod], (gg, 'ABCDEHLMPRST'.index(mm)+1, aa)
+    return sesso, tabella('territori')[cod], (gg, 'ABCDEHLMPRST'.index(mm)+1, aa)
 
 def get_data_di_nascita(data, F=0):
     "Ricava 5 caratteri da data di nascita (gg,mm,aaaa) e sesso"
@@ -183,5 +187,5 @@ def crc_piva(n):
 
 def get_ufficio_iva(n):
     cod = n[7:10]
-    uff = uffici.get(cod) or 'UFFICIO INESISTENTE'
+    uff = tabella('uffici').get(cod) or 'UFFICIO INESISTENTE'
     return uff
@@ -1,12 +1,11 @@
 # -*- coding: windows-1252 -*-
-import cmd, sys, traceback, json
+import cmd, sys, traceback
 from shlex import split, join
 from datetime import date
 
 from cf import get_codice_fiscale, get_omocodici, get_ctl_chr, crc_piva, get_ufficio_iva, get_dati_cf
 from iban import iban_validate, iban_gen_IT, bban_check_gen_IT
-
-banche = json.load(open('banche.json'))
+from tabelle import tabella
 
 
 class Shell(cmd.Cmd):
@@ -96,7 +95,7 @@ class Shell(cmd.Cmd):
                     if c == arg[4] and arg[5:10].isdigit() and arg[10:15].isdigit() :
                         print('BBAN italiano formalmente valido')
                         abi = arg[5:10]
-                        banca = banche.get(abi)
+                        banca = tabella('banche').get(abi)
                         if banca:
                             print(f'ABI {abi} designa {banca[0]}')
                             cab = arg[10:15]
@@ -0,0 +1,57 @@
+"Caricamento pigro delle tabelle di territori, uffici IVA e banche, da snapshot precompilati con marshal o dai file JSON"
+import os, marshal # json solo se serve: caricando gli snapshot non lo si importa
+
+CARTELLA = os.path.dirname(os.path.abspath(__file__)) # le tabelle stanno accanto al modulo, non nella cartella corrente
+
+_tabelle = {} # tabelle gia' caricate
+
+def percorso(nome, ext):
+    return os.path.join(CARTELLA, nome + ext)
+
+def compila(nome):
+    "Genera lo snapshot marshal della tabella 'nome' dal suo file JSON, restituendo la tabella"
+    import json
+    dati = json.load(open(percorso(nome, '.json')))
+    tmp = percorso(nome, '.marshal.tmp')
+    with open(tmp, 'wb') as f:
+        marshal.dump(dati, f)
+    os.replace(tmp, percorso(nome, '.marshal'))
+    return dati
+
+def salva(nome, dati):
+    "Salva la tabella 'nome' in JSON e nel suo snapshot"
+    import json
+    json.dump(dati, open(percorso(nome, '.json'), 'w'))
+    compila(nome)
+
+def tabella(nome):
+    """Restituisce la tabella 'nome', caricandola al primo uso dallo snapshot,
+    se non piu' vecchio del file JSON; altrimenti dal file JSON, rigenerando
+    lo snapshot se possibile"""
+    t = _tabelle.get(nome)
+    if t is not None: return t
+    snap = percorso(nome, '.marshal')
+    try:
+        js = os.path.getmtime(percorso(nome, '.json'))
+    except OSError:
+        js = 0
+    try:
+        if os.path.getmtime(snap) >= js:
+            with open(snap, 'rb') as f:
+                t = marshal.loads(f.read()) # molto piu' veloce di marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError): # snapshot assente o di un'altra versione di Python
+        pass
+    if t is None:
+        try:
+            t = compila(nome)
+        except OSError: # cartella in sola lettura
+            import json
+            t = json.load(open(percorso(nome, '.json')))
+    _tabelle[nome] = t
+    return t
+
+
+if __name__ == '__main__':
+    for nome in ('territori', 'uffici', 'banche'):
+        compila(nome)
+        print(f'Snapshot di {nome}.json generato in {nome}.marshal')
@@ -1,7 +1,9 @@
 "Estrae un elenco di succursali degli intermediari finanziari attivi in Italia da un report XML della Banca d'Italia"
 import xml.etree.ElementTree as ET
 from xml.dom.minidom import parseString
-import json
+import sys, os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tabelle import salva
 
 tree = ET.parse('2025-03-17_SUCCURSALI_BANCHE.xml') # v. https://infostat.bancaditalia.it/GIAVAInquiry-public/ng/area-download
 root = tree.getroot()
@@ -26,5 +28,5 @@ for r in root.findall('.//ROW'):
     via = r.find('INDIRIZZO').text
     intermediari[abi][1][cab] = (comune, via)
 
-json.dump(banche, open('banche.json','w'))
-print('Elenco delle banche con sportelli in Italia generato in banche.json')
+salva('banche', intermediari)
+print('Elenco delle banche con sportelli in Italia generato in banche.json e banche.marshal')
@@ -1,6 +1,8 @@
 "Esporta in un file json Comune (o Stato estero), sigla automobilistica e codice catastale da un file .cfg delle app SOGEI e dai fogli XSLX dell'ISTAT"
 from openpyxl import load_workbook
-import json
+import sys, os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tabelle import salva
 
 territori = {} # {CODICE_CAT: (nome, sigla)}
 
@@ -33,5 +35,5 @@ for row in rows:
     if row[4].value in (None, 'n.d'): continue
     territori[row[4].value] = (row[7].value.upper(), "EE")
 
-json.dump(territori, open('territori.json','w'))
-print('Elenco dei codici catastali di Comuni e Stati esteri generato in territori.json')
+salva('territori', territori)
+print('Elenco dei codici catastali di Comuni e Stati esteri generato in territori.json e territori.marshal')
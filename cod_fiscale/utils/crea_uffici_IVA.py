@@ -1,6 +1,8 @@
 "Crea una tabella di codici ufficio IVA riportati da Wikipedia (alcuni mancano dall'Agenzia delle Entrate)"
 from openpyxl import load_workbook
-import json
+import sys, os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tabelle import salva
 
 print ('Carico i codici ufficio IVA...')
 wb = load_workbook('uffici_IVA_wikipedia.xlsx')
@@ -17,5 +19,5 @@ for row in rows:
     except:
         pass
 
-json.dump(uffici, open('uffici.json','w'))
-print('Elenco degli uffici IVA generato in uffici.json')
+salva('uffici', uffici)
+print('Elenco degli uffici IVA generato in uffici.json e uffici.marshal')
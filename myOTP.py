@@ -4,83 +4,256 @@
 
 # Given a base32 encoded secret key on command line,
 # it displays current TOTP and expiration time
-import sys, struct, time, base64
+import sys, struct, time, base64, getopt, os, mmap, bisect, json, selectors, threading, asyncio
+from array import array
+from collections import OrderedDict, deque, Counter
+from hmac import compare_digest
 from hashlib import sha1, sha256, sha512
-from socket import socket, AF_INET, SOCK_DGRAM
+from socket import socket, create_connection, getaddrinfo, AF_INET, SOCK_STREAM, SOCK_DGRAM
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+
+NTP_SERVERS = ("time.google.com", "it.pool.ntp.org", "time-a-g.nist.gov", "time.inrim.it", "time.facebook.com", "time.windows.com", "ntp.nict.jp", "clock.isc.org", "ntp.metas.ch")
+NTP_PORT = 123
+NTP_CACHE = os.path.join(os.path.expanduser('~'), '.myOTP_ntp.json') # last offset found, to start at once
+UNIX_NTP_OFFSET = 2208988800 # NTP time is s since 1/1/1900, Unix since 1/1/1970
 
 class NTPclock:
-    "Adjust local Unix time synchronizing with a NTP server"
+    """Adjust local Unix time synchronizing with NTP servers, the first time
+    it is needed. All 'servers' (names, or (host, port) tuples) are queried at
+    once, waiting for their replies up to 'timeout' seconds overall. The
+    offset found is kept in a 'cache' file (if any) for 'ttl' seconds.
+    Started, a background thread keeps the clock synchronized: the offset
+    chosen at each poll (the median of the replies with less delay) feeds a
+    model of the local clock drift, so the time stays accurate between polls"""
     # Offset can increase with suspension etc.
     # On Windows, use "w32tm /resync" as Admin to resync clock
-    def __init__ (p):
-        UNIX_NTP_OFFSET = 2208988800 # NTP time is s since 1/1/1900, Unix since 1/1/1970
+    def __init__ (p, servers=NTP_SERVERS, port=NTP_PORT, timeout=2, cache=NTP_CACHE, ttl=3600, window=64):
+        p.servers = [s if isinstance(s, tuple) else (s, port) for s in servers]
+        p.timeout = timeout
+        p.cache = cache
+        p.ttl = ttl
+        p.samples = deque(maxlen=window) # (local time, server, offset, delay, jitter) of the last replies
+        p.history = deque(maxlen=16) # (local time, offset) chosen at the last polls
+        p.drift = 0.0 # seconds gained by the offset every second
+        p.jitter = 0.0 # RMS deviation of the chosen replies from their median
+        p.poll = None # seconds between polls of the background thread
+        p._tried = False
+        p._lock = threading.Lock()
+        p._thread = None
+
+    @property
+    def offset(p):
+        "Clock offset in seconds, found on first use"
+        if not p._tried:
+            p._tried = True
+            if not p.load():
+                p.sync()
+        return p.offset_at(time.time())
+
+    def offset_at(p, t):
+        "Clock offset at local Unix time 't', predicted by the drift model"
+        with p._lock:
+            if not p.history: return 0.0
+            t0, offset = p.history[-1]
+            return offset + p.drift*(t - t0)
+
+    def load(p):
+        "Load the cached offset, if any and not expired"
+        try:
+            with open(p.cache) as f:
+                c = json.load(f)
+            if c['servers'] == [list(s) for s in p.servers] and 0 <= time.time() - c['time'] < p.ttl:
+                with p._lock:
+                    p.history.append((c['time'], c['offset']))
+                    p.drift = c.get('drift', 0.0)
+                return True
+        except (TypeError, OSError, ValueError, KeyError):
+            pass
+        return False
+
+    def save(p):
+        if not p.cache: return
+        t = time.time()
+        try:
+            with open(p.cache, 'w') as f:
+                json.dump(dict(offset=p.offset_at(t), drift=p.drift, time=t, servers=p.servers), f)
+        except OSError:
+            pass
+
+    def query(p, verbose=True):
+        "Query all the servers at once, and return a list of (server, offset, delay) samples"
+        deadline = time.monotonic() + p.timeout
+        # resolve names in parallel, since lookups block
+        pool = ThreadPoolExecutor(len(p.servers))
+        lookups = {pool.submit(getaddrinfo, host, port, AF_INET, SOCK_DGRAM): (host, port) for host, port in p.servers}
+        done = wait(lookups, max(0, deadline - time.monotonic()))[0]
+        pool.shutdown(wait=False) # don't wait for late lookups
         client = socket(AF_INET, SOCK_DGRAM) # Internet, UDP
-        client.settimeout(2)
-        ntp_servers = ("time.google.com", "it.pool.ntp.org", "time-a-g.nist.gov", "time.inrim.it", "time.facebook.com", "time.windows.com", "ntp.nict.jp", "clock.isc.org", "ntp.metas.ch")
-        ntp_queried = 0
-        mean_offset = 0
-        for addr in ntp_servers:
-            address = (addr, 123) # NTP server & port
+        client.setblocking(False)
+        sent = {} # transmit timestamp: server, when data left from client (NTP time)
+        for f in lookups:
+            if f not in done or f.exception(): continue
             data = bytearray(48); data[0] = 27 # hex message to send to the server (NTPv3)
-            client.sendto(data, address)
-            T1 = time.time() + UNIX_NTP_OFFSET # when data left from client (NTP time)
+            T1 = time.time() + UNIX_NTP_OFFSET
+            # the server echoes our transmit timestamp, that tells replies apart (made unique by its low bits)
+            struct.pack_into('!II', data, 40, int(T1), (int((T1 % 1) * (1<<32)) & ~0xFF) | len(sent))
             try:
-                data, address = client.recvfrom(48)
+                client.sendto(data, f.result()[0][4])
+            except OSError:
+                continue
+            sent[bytes(data[40:48])] = (lookups[f], T1)
+        samples = []
+        with selectors.DefaultSelector() as sel:
+            sel.register(client, selectors.EVENT_READ)
+            while sent and sel.select(max(0, deadline - time.monotonic())):
+                try:
+                    data, address = client.recvfrom(512)
+                except OSError: # i.e. an ICMP port unreachable, on Windows
+                    continue
                 T4 = time.time() + UNIX_NTP_OFFSET # when data came back from server
-                A = struct.unpack("!3Bb11I", data)
+                if len(data) < 48 or data[24:32] not in sent: continue
+                server, T1 = sent.pop(data[24:32])
+                A = struct.unpack("!3Bb11I", data[:48])
+                if A[0] & 7 != 4 or A[1] == 0: # not a server reply, or a "kiss of death"
+                    if verbose: print('WARNING: NTP server %s refused to answer' % server[0])
+                    continue
                 T2 = A[11] + float(A[12]) / (1<<32) # when data arrived at server
                 T3 = A[13] + float(A[14]) / (1<<32) # when data left from server
-                mean_offset += ((T2-T1)+(T3-T4)) / 2
-                ntp_queried += 1
-            except:
-                print('WARNING: could not reach NTP server', addr)
-        p.offset = mean_offset / ntp_queried
-        print('INFO: calculated clock offset is %f second(s)' %  p.offset)
-    
+                samples += [(server, ((T2-T1)+(T3-T4)) / 2, (T4-T1) - (T3-T2))]
+        client.close()
+        if verbose:
+            for server, T1 in sent.values():
+                print('WARNING: could not reach NTP server', server[0])
+            for f in lookups:
+                if f not in done or f.exception():
+                    print('WARNING: could not resolve NTP server', lookups[f][0])
+        return samples
+
+    def sync(p, verbose=True):
+        """Query the servers and update the offset and the drift model. Return
+        the difference between the offset found and the one predicted, or None
+        if no server answered or nothing could be predicted yet"""
+        samples = p.query(verbose)
+        if not samples:
+            if verbose: print('WARNING: no NTP server answered, using the local clock')
+            return None
+        now = time.time()
+        # replies delayed the least are the most accurate: take the median of their best half,
+        # of 3 replies at least and odd sized, so that a single falseticker can't move it
+        best = sorted(samples, key=lambda s: s[2])[:min(len(samples), max(3, (len(samples)+1)//2) | 1)]
+        offsets = sorted(s[1] for s in best)
+        median = (offsets[(len(offsets)-1)//2] + offsets[len(offsets)//2]) / 2
+        predicted = p.offset_at(now) if p.history else None
+        with p._lock:
+            for server, offset, delay in samples:
+                p.samples.append((now, server[0], offset, delay, offset - median))
+            p.jitter = (sum((o - median)**2 for o in offsets) / len(offsets)) ** 0.5
+            p.history.append((now, median))
+            # least squares slope of the offsets chosen in time
+            if len(p.history) > 1:
+                tm = sum(t for t, o in p.history) / len(p.history)
+                om = sum(o for t, o in p.history) / len(p.history)
+                var = sum((t - tm)**2 for t, o in p.history)
+                if var > 0:
+                    p.drift = sum((t - tm)*(o - om) for t, o in p.history) / var
+        if verbose: print('INFO: calculated clock offset is %f second(s)' %  median)
+        p.save()
+        if predicted != None:
+            return median - predicted
+
+    def start(p, min_poll=64, max_poll=1024):
+        """Keep the clock synchronized in a background thread, polling every
+        'min_poll' seconds at first, and up to 'max_poll' while it keeps stable"""
+        if p._thread: return
+        if not p._tried:
+            p._tried = True
+            p.load() # to start from the cached offset, until the first poll
+        p._stop = threading.Event()
+        p.poll = min_poll
+        def run():
+            while True:
+                error = p.sync(False)
+                # poll less often while the model predicts the offset within the jitter
+                if error != None and abs(error) < max(4*p.jitter, 0.002):
+                    p.poll = min(max_poll, p.poll*2)
+                else:
+                    p.poll = max(min_poll, p.poll//2)
+                if p._stop.wait(p.poll): break
+        p._thread = threading.Thread(target=run, name='NTPclock', daemon=True)
+        p._thread.start()
+
+    def stop(p):
+        "Stop the background thread"
+        if not p._thread: return
+        p._stop.set()
+        p._thread.join()
+        p._thread = None
+
     def time(p):
         "Adjusted Unix time"
         return time.time() + p.offset
 
 clock = NTPclock()
 
+HASHES = {'sha1': sha1, 'sha256': sha256, 'sha512': sha512}
+IPAD = bytes(x ^ 0x36 for x in range(256)) # translation tables to XOR key bytes
+OPAD = bytes(x ^ 0x5C for x in range(256))
+
+def HMAC_states(k, h):
+    "Get the inner and outer hash objects of HMAC with key 'k' and hash 'h', before any message. See RFC 2104"
+    size = h().block_size # 64 bytes for SHA-1 and SHA-256, 128 for SHA-512
+    if len(k) > size:
+        k = h(k).digest()
+    k = bytes(k).ljust(size, b'\0')
+    return h(k.translate(IPAD)), h(k.translate(OPAD))
+
 def HMAC(k, m, h):
     "Get the binary HMAC for message 'm' using key 'k' and hash 'h'. See RFCs 2104 and 2202"
-    if len(k) > 64:
-        k = h(k).digest()
-    j = len(k)
-    opad = bytearray(64*b'\x5C')
-    ipad = bytearray(64*b'\x36')
-    while j:
-        j -= 1
-        opad[j] = 0x5C ^ k[j]
-        ipad[j] = 0x36 ^ k[j]
-    d = h(opad)
-    d.update(h(ipad+m).digest())
-    return d.digest()
+    inner, outer = HMAC_states(k, h)
+    inner.update(m)
+    outer.update(inner.digest())
+    return outer.digest()
+
+
+class OTPKey:
+    """A HOTP key with its HMAC hash states computed once, so that every
+    password costs just two hash copies and updates"""
+    def __init__ (p, k, h='sha1'):
+        if h not in HASHES:
+            raise BaseException("HOTP hash must be one of SHA-1 (default), SHA-256 or SHA-512!")
+        p.hash = h
+        p.inner, p.outer = HMAC_states(k, HASHES[h])
+        p.id = (h, p.outer.digest()) # the same for every OTPKey of the same key, without keeping it
+
+    def hmac(p, m):
+        "Get the binary HMAC for message 'm'"
+        inner = p.inner.copy()
+        inner.update(m)
+        outer = p.outer.copy()
+        outer.update(inner.digest())
+        return outer.digest()
+
+    def hotp(p, c, d=6):
+        "Get 'd' digits from the HOTP for counter 'c'. See RFC 4226"
+        if not (5 < d < 11):
+            raise BaseException("HOTP must be from 6 to 10 decimal digits long!")
+        if c < 0:
+            raise BaseException("HOTP counter can't be negative!")
+        # 1. Computate HMAC for counter 'c' as a BE QWORD
+        b = p.hmac(struct.pack('>Q', c))
+        # 2. Extract a BE DWORD (32-bit) from HMAC according to its last byte, zeroing its MSB
+        i = b[-1] & 0xF
+        dec = struct.unpack_from('>I', b, i)[0] & 0x7FFFFFFF
+        # 3. Pick the (least significant) requested digits
+        return ('%010d'%dec)[-d:]
 
 
 def HOTP(k, c, d=6, h='sha1'):
-    """Get 'd' digits from the HMAC-based One Time Password for key 'k' and
-    counter 'c', using hash 'h'. See RFC 4226"""
-    if h not in ('sha1', 'sha256', 'sha512'):
-        raise BaseException("HOTP hash must be one of SHA-1 (default), SHA-256 or SHA-512!")
-    if not (5 < d < 11):
-        raise BaseException("HOTP must be from 6 to 10 decimal digits long!")
-    if c < 0:
-        raise BaseException("HOTP counter can't be negative!")
-    h=globals()[h]
-    # 1. Make counter 'c' a BE QWORD
-    b = bytearray(8)
-    struct.pack_into('>Q', b, 0, c)
-    # 2. Computate HMAC for counter
-    b = bytearray(HMAC(k, b, h))
-    # 3. Extract a BE DWORD (32-bit) from HMAC according to its last byte
-    i = b[-1] & 0xF
-    b[i] &= 0x7F # Zero DWORD MSB
-    # 5. Convert it into decimal
-    dec = struct.unpack_from('>I', b, i)[0]
-    # 6. Pick the (least significant) requested digits
-    return ('%010d'%dec)[-d:]
+    """Get 'd' digits from the HMAC-based One Time Password for key 'k' (or
+    an OTPKey) and counter 'c', using hash 'h'. See RFC 4226"""
+    if not isinstance(k, OTPKey):
+        k = OTPKey(k, h)
+    return k.hotp(c, d)
 
 
 def TOTP(k, TI=30, d=6, h='sha1', T=None):
@@ -99,24 +272,470 @@ def TOTPT(k, TI=30, d=6, h='sha1', T=None):
     return HOTP(k, TC, d, h), TI - (int(T) - TC*TI)
 
 
-def ValidateTOTP(totp, k, TI=30, I=1, d=6, h='sha1'):
-    """Validate a 'totp' of 'd' digits within 'I' intervals of 'TI' seconds,
-    given a 'k' key. See RFC 6238"""
-    T = int(clock.time()) - TI*I
-    totps = [] # odd list, median == current OTP
-    i = I*2+1
-    while i:
-        totps += [TOTP(k, TI, d, T)]
-        T += TI*I
-        i -= 1
-    return (totp in totps)
+class Authenticator:
+    """Many TOTP accounts, with their own interval, digits and hash. Every
+    code is computed once per interval, and kept until it expires"""
+    def __init__ (p):
+        p.accounts = OrderedDict() # name: [OTPKey, interval, digits, counter, TOTP]
+
+    def add(p, name, k, TI=30, d=6, h='sha1'):
+        "Add (or replace) the account 'name' with key 'k' (or an OTPKey)"
+        if not isinstance(k, OTPKey):
+            k = OTPKey(k, h)
+        p.accounts[name] = [k, TI, d, None, None]
+
+    def remove(p, name):
+        del p.accounts[name]
+
+    def code(p, name, T=None):
+        "Get the TOTP of account 'name' at Unix time 'T' (default: current time) and the time it expires"
+        if T == None: T = clock.time()
+        a = p.accounts[name]
+        k, TI, d, TC, totp = a
+        if int(T) // TI != TC:
+            TC = a[3] = int(T) // TI
+            totp = a[4] = k.hotp(TC, d)
+        return totp, (TC+1) * TI
+
+    def codes(p, T=None):
+        "Get a list of (name, TOTP, expiration time) for all the accounts"
+        if T == None: T = clock.time()
+        return [(name,) + p.code(name, T) for name in p.accounts]
+
+    def next_change(p, T=None):
+        "Get the seconds left before the next code of any account expires"
+        if T == None: T = clock.time()
+        return min((TI - T % TI for k, TI, d, TC, totp in p.accounts.values()), default=None)
+
+
+def same_otp(a, b):
+    "Compare two OTP strings in constant time"
+    return compare_digest(a.encode(), b.encode())
+
+
+def ValidateTOTP(totp, k, TI=30, I=1, d=6, h='sha1', T=None):
+    """Validate a 'totp' of 'd' digits within 'I' intervals of 'TI' seconds
+    around a 'T' Unix time (default: current time), given a 'k' key (or an
+    OTPKey). See RFC 6238"""
+    if T == None: T = clock.time()
+    TC = int(T) // TI
+    if not isinstance(k, OTPKey):
+        k = OTPKey(k, h)
+    return any(same_otp(k.hotp(c, d), totp) for c in range(max(0, TC-I), TC+I+1))
+
+
+def ValidateHOTP(hotp, k, c, W=10, d=6, h='sha1'):
+    """Validate a 'hotp' of 'd' digits for key 'k' (or an OTPKey), looking
+    ahead up to 'W' counters after the expected 'c' to resynchronize with the
+    token. Return the counter to expect next, or None if not valid. See RFC 4226"""
+    if not isinstance(k, OTPKey):
+        k = OTPKey(k, h)
+    for i in range(c, c+W+1):
+        if same_otp(k.hotp(i, d), hotp):
+            return i+1
+    return None
+
+
+def ResyncHOTP(hotp1, hotp2, k, c, W=100, d=6, h='sha1'):
+    """Resynchronize with a token that ran far ahead of the expected counter
+    'c', by finding two consecutive 'hotp1' and 'hotp2' within 'W' counters.
+    Return the counter to expect next, or None if not found. See RFC 4226"""
+    if not isinstance(k, OTPKey):
+        k = OTPKey(k, h)
+    for i in range(c, c+W+1):
+        if same_otp(k.hotp(i, d), hotp1) and same_otp(k.hotp(i+1, d), hotp2):
+            return i+2
+    return None
+
+
+class TOTPValidator:
+    """Validate TOTPs within 'I' intervals of 'TI' seconds, rejecting replays:
+    for each key, the last accepted counter is remembered until it leaves
+    the window, and codes at or before it are refused. At most 'size' keys
+    are remembered, the least recently used ones being forgotten first"""
+    def __init__ (p, TI=30, I=1, d=6, size=1<<16):
+        p.TI, p.I, p.d, p.size = TI, I, d, size
+        p.accepted = OrderedDict() # key id: last accepted counter
+
+    def validate(p, totp, k, kid=None, T=None):
+        """Validate a 'totp' for 'k' (an OTPKey, or a key and SHA-1), at a 'T'
+        Unix time (default: current time). Replays are tracked by 'kid', or
+        by the key itself (also if rebuilt as a new OTPKey)"""
+        if T == None: T = clock.time()
+        TC = int(T) // p.TI
+        if not isinstance(k, OTPKey):
+            k = OTPKey(k)
+        if kid == None: kid = k.id
+        # drop the counters left out of the window
+        while p.accepted and next(iter(p.accepted.values())) < TC - p.I:
+            p.accepted.popitem(last=False)
+        first = max(0, TC - p.I)
+        last = p.accepted.get(kid)
+        if last != None:
+            first = max(first, last+1)
+        for c in range(first, TC+p.I+1):
+            if same_otp(k.hotp(c, p.d), totp):
+                p.accepted[kid] = c
+                p.accepted.move_to_end(kid)
+                if len(p.accepted) > p.size:
+                    p.accepted.popitem(last=False)
+                return True
+        return False
+
+
+class SecretStore:
+    """A compact, read-only store of the secrets of many users, sorted by
+    (integer) user id in fixed size records: user id, hash, secret length
+    and secret of up to 54 bytes. Records live in a bytes-like buffer, that
+    can be a file mapped in memory"""
+    RECORD = struct.Struct('<QBB54s')
+    HASH_IDS = tuple(HASHES) # hash names by their number in a record
+
+    def __init__ (p, buf=b'', name=None):
+        if len(buf) % p.RECORD.size:
+            raise BaseException("Secret store size is not a multiple of a record!")
+        p.buf = buf
+        p.name = name
+        p.uids = array('Q', (r[0] for r in p.RECORD.iter_unpack(buf)))
+
+    @classmethod
+    def build(cls, items):
+        "Make a store from (user id, secret, hash) items"
+        buf = bytearray()
+        for uid, k, h in sorted(items):
+            if len(k) > 54:
+                raise BaseException("Secret store keys can't be longer than 54 bytes!")
+            buf += cls.RECORD.pack(uid, cls.HASH_IDS.index(h), len(k), k)
+        return cls(buf)
+
+    @classmethod
+    def open(cls, name):
+        "Map a store file in memory"
+        with open(name, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(name) else b''
+        return cls(buf, name)
+
+    def save(p, name):
+        with open(name, 'wb') as f:
+            f.write(p.buf)
+
+    def __len__ (p): return len(p.uids)
+
+    def __reduce__ (p):
+        # a mapped store is reopened by name in worker processes, once each
+        if p.name: return (_open_store, (p.name,))
+        return (SecretStore, (bytes(p.buf),))
+
+    def key(p, uid):
+        "Get the OTPKey of user 'uid', or None if unknown"
+        i = bisect.bisect_left(p.uids, uid)
+        if i == len(p.uids) or p.uids[i] != uid:
+            return None
+        uid, h, n, k = p.RECORD.unpack_from(p.buf, i*p.RECORD.size)
+        return OTPKey(k[:n], p.HASH_IDS[h])
+
+_stores = {} # stores opened by name in this process
+
+def _open_store(name):
+    if name not in _stores:
+        _stores[name] = SecretStore.open(name)
+    return _stores[name]
+
+def _validate_chunk(store, pairs, TC, I, d):
+    "Validate (user id, TOTP) pairs within 'I' intervals of the 'TC' counter"
+    ok = []
+    for uid, totp in pairs:
+        k = store.key(uid)
+        ok += [k != None and any(same_otp(k.hotp(c, d), totp) for c in range(max(0, TC-I), TC+I+1))]
+    return ok
+
+def ValidateTOTPBatch(pairs, store, TI=30, I=1, d=6, T=None, pool=None, chunk=256):
+    """Validate many (user id, TOTP) 'pairs' of 'd' digits within 'I'
+    intervals of 'TI' seconds, with the keys in a SecretStore, at the same
+    'T' Unix time (default: current time). If a thread or process 'pool'
+    executor is given, pairs are split among its workers in 'chunk' pairs at
+    a time: a process pool needs a store opened from a file, which workers
+    map once. Return a list of booleans"""
+    if isinstance(pool, ProcessPoolExecutor) and not store.name:
+        raise BaseException("A process pool needs a secret store opened from a file!")
+    if T == None: T = clock.time()
+    TC = int(T) // TI
+    pairs = list(pairs)
+    if not pool:
+        return _validate_chunk(store, pairs, TC, I, d)
+    futures = [pool.submit(_validate_chunk, store, pairs[i:i+chunk], TC, I, d) for i in range(0, len(pairs), chunk)]
+    ok = []
+    for f in futures:
+        ok += f.result()
+    return ok
+
+
+
+def split_address(address):
+    "Get a (host, port) tuple from a 'host:port' address, or a Unix socket path as is"
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return host or 'localhost', int(port)
+    return address
+
+class OTPServer:
+    """Serve TOTP generation and validation requests, one JSON object per
+    line, over a TCP or Unix socket. Requests name a user of a SecretStore,
+    or carry a base32 key (and hash):
+        {"id": 1, "op": "generate", "user": 42}
+        {"id": 2, "op": "validate", "user": 42, "code": "123456"}
+        {"id": 3, "op": "validate", "key": "JBSWY3DPEHPK3PXP", "hash": "sha1", "code": "123456"}
+        {"id": 4, "op": "stats"}
+    Replies echo the "id", with "code" and "expires", "ok", or "error". All
+    the requests waiting are served in a batch, at the same time step of the
+    shared clock, and valid codes can't be replayed"""
+    def __init__ (p, store=None, TI=30, I=1, d=6):
+        p.store = store
+        p.TI, p.d = TI, d
+        p.validator = TOTPValidator(TI, I, d)
+        p.keys = OrderedDict() # recently used OTPKeys
+        p.counters = Counter()
+        p.latencies = deque(maxlen=4096) # seconds taken by the last requests
+        p.started = time.time()
+        p.queue = None
+
+    def key(p, req):
+        "Get the OTPKey of a request, and the id tracking its replays"
+        if 'user' in req:
+            kid = ('user', int(req['user']))
+        else:
+            kid = (base64.b32decode(req['key']), req.get('hash', 'sha1'))
+        k = p.keys.get(kid)
+        if k:
+            p.keys.move_to_end(kid)
+            return k, kid
+        if 'user' in req:
+            k = p.store.key(kid[1]) if p.store else None
+            if not k:
+                raise BaseException('unknown user %d' % kid[1])
+        else:
+            k = OTPKey(*kid)
+        p.keys[kid] = k
+        if len(p.keys) > 4096:
+            p.keys.popitem(last=False)
+        return k, kid
+
+    def execute(p, req, T):
+        "Serve a single request at Unix time 'T'"
+        op = req.get('op')
+        if op == 'stats':
+            return p.stats()
+        if op not in ('generate', 'validate'):
+            raise BaseException('unknown operation %r' % op)
+        k, kid = p.key(req)
+        if op == 'generate':
+            TC = int(T) // p.TI
+            return {'code': k.hotp(TC, p.d), 'expires': (TC+1) * p.TI}
+        return {'ok': p.validator.validate(str(req['code']), k, kid, T)}
+
+    def run_batch(p, batch):
+        "Serve a batch of requests, all at the same time step"
+        T = clock.time()
+        replies = []
+        for req in batch:
+            try:
+                reply = p.execute(req, T)
+            except BaseException as e: # as raised by this module, too
+                reply = {'error': str(e) or e.__class__.__name__}
+            if 'error' in reply: p.counters['errors'] += 1
+            replies += [reply]
+        return replies
+
+    async def batcher(p):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await p.queue.get()]
+            while not p.queue.empty():
+                batch += [p.queue.get_nowait()]
+            # compute in a thread, while more requests queue up for the next batch
+            replies = await loop.run_in_executor(None, p.run_batch, [req for req, fut in batch])
+            for (req, fut), reply in zip(batch, replies):
+                if not fut.done(): fut.set_result(reply)
+            p.counters['batches'] += 1
+
+    async def respond(p, req, writer):
+        t = time.perf_counter()
+        fut = asyncio.get_running_loop().create_future()
+        p.queue.put_nowait((req, fut))
+        reply = await fut
+        if 'id' in req: reply['id'] = req['id']
+        writer.write(json.dumps(reply).encode() + b'\n')
+        p.counters['requests'] += 1
+        p.counters[req.get('op')] += 1
+        p.latencies.append(time.perf_counter() - t)
+
+    async def handle(p, reader, writer):
+        tasks = set() # pipelined requests are served concurrently
+        try:
+            while line := await reader.readline():
+                try:
+                    req = json.loads(line)
+                    if not isinstance(req, dict): raise ValueError('not an object')
+                except ValueError as e:
+                    writer.write(json.dumps({'error': 'bad request: %s' % e}).encode() + b'\n')
+                    p.counters['errors'] += 1
+                    continue
+                task = asyncio.create_task(p.respond(req, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                await writer.drain()
+            if tasks: await asyncio.wait(tasks)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def stats(p):
+        "Get the counters of the server"
+        lat = sorted(p.latencies)
+        up = time.time() - p.started
+        c = p.counters
+        return {'uptime': round(up, 1), 'requests': c['requests'], 'generate': c['generate'], 'validate': c['validate'],
+            'errors': c['errors'], 'batches': c['batches'], 'batch_mean': round(c['requests'] / c['batches'], 2) if c['batches'] else 0,
+            'requests_s': round(c['requests'] / up, 1) if up else 0,
+            'latency_ms': {'mean': round(sum(lat) / len(lat) * 1e3, 3), 'p50': round(lat[len(lat)//2] * 1e3, 3),
+                'p99': round(lat[len(lat)*99//100] * 1e3, 3), 'max': round(lat[-1] * 1e3, 3)} if lat else {}}
+
+    async def serve(p, address):
+        "Serve requests on 'address' ('host:port' or a Unix socket path) until cancelled"
+        p.queue = asyncio.Queue()
+        batcher = asyncio.create_task(p.batcher())
+        address = split_address(address)
+        if isinstance(address, tuple):
+            server = await asyncio.start_server(p.handle, *address)
+        else:
+            server = await asyncio.start_unix_server(p.handle, address)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+class OTPClient:
+    "A blocking client of an OTPServer at 'address' ('host:port' or a Unix socket path)"
+    def __init__ (p, address, timeout=10):
+        address = split_address(address)
+        if isinstance(address, tuple):
+            p.sock = create_connection(address, timeout)
+        else:
+            from socket import AF_UNIX # not on Windows
+            p.sock = socket(AF_UNIX, SOCK_STREAM)
+            p.sock.settimeout(timeout)
+            p.sock.connect(address)
+        p.f = p.sock.makefile('rwb')
+        p.id = 0
+
+    def call(p, **req):
+        "Send a request and wait for its reply"
+        p.id += 1
+        req['id'] = p.id
+        p.f.write(json.dumps(req).encode() + b'\n')
+        p.f.flush()
+        while True:
+            line = p.f.readline()
+            if not line:
+                raise BaseException('connection closed by the server')
+            reply = json.loads(line)
+            if reply.get('id') in (p.id, None): break
+        if 'error' in reply:
+            raise BaseException(reply['error'])
+        return reply
+
+    def _key(p, user, k, h):
+        if user != None: return {'user': user}
+        return {'key': base64.b32encode(k).decode(), 'hash': h}
+
+    def generate(p, user=None, k=None, h='sha1'):
+        "Get the current TOTP of a 'user' of the server store, or of key 'k'"
+        return p.call(op='generate', **p._key(user, k, h))['code']
+
+    def validate(p, totp, user=None, k=None, h='sha1'):
+        "Validate a 'totp' of a 'user' of the server store, or of key 'k'"
+        return p.call(op='validate', code=totp, **p._key(user, k, h))['ok']
+
+    def stats(p):
+        return p.call(op='stats')
+
+    def close(p):
+        p.f.close()
+        p.sock.close()
 
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
+    opts, args = getopt.getopt(sys.argv[1:], 's:b:j:d:l:k:')
+    if not (args or opts):
         print('Syntax: myOTP.py BASE32_KEY') # expects a "shared secret" (=key, typically 80-bit), base32 encoded
+        print('        myOTP.py -s STORE < "USER_ID BASE32_KEY [HASH]" lines')
+        print('        myOTP.py -b STORE [-j N] [-d N] < "USER_ID TOTP" lines')
+        print('        myOTP.py -l ADDRESS [-k STORE] [-d N]\n')
+        print('  -s STORE  save the secrets of many users to a store file')
+        print('  -b STORE  validate many TOTPs with the secrets in a store file')
+        print('  -j N      validate with N processes (0 = one per CPU)')
+        print('  -d N      TOTP digits (default: 6)')
+        print('  -l ADDRESS  serve TOTP requests on a "host:port" or a Unix socket path')
+        print('  -k STORE  with -l, serve the users of a store file')
         sys.exit(1)
-    k = base64.b32decode(sys.argv[1])
+
+    jobs = 1
+    digits = 6
+    storename = None
+    batch = False
+    address = None
+    for o, a in opts:
+        if o == '-s':
+            storename = a
+        if o == '-b':
+            storename = a
+            batch = True
+        if o == '-j':
+            jobs = int(a) or os.cpu_count()
+        if o == '-d':
+            digits = int(a)
+        if o == '-l':
+            address = a
+        if o == '-k':
+            storename = a
+
+    if address:
+        server = OTPServer(SecretStore.open(storename) if storename else None, d=digits)
+        clock.start() # keeps the shared clock synchronized in background
+        print('Serving TOTP requests on %s' % address)
+        try:
+            asyncio.run(server.serve(address))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if storename and not batch:
+        items = []
+        for line in sys.stdin:
+            if not line.split(): continue
+            uid, k, h = (line.split() + ['sha1'])[:3]
+            items += [(int(uid), base64.b32decode(k), h)]
+        SecretStore.build(items).save(storename)
+        print('Saved %d secret(s) to "%s".' % (len(items), storename))
+        sys.exit(0)
+
+    if batch:
+        store = SecretStore.open(storename)
+        pairs = [(int(uid), totp) for uid, totp in (line.split() for line in sys.stdin if line.split())]
+        pool = ProcessPoolExecutor(jobs) if jobs > 1 else None
+        t = time.perf_counter()
+        ok = ValidateTOTPBatch(pairs, store, d=digits, pool=pool)
+        t = time.perf_counter() - t
+        if pool: pool.shutdown()
+        for (uid, totp), valid in zip(pairs, ok):
+            if not valid: print('User %d: invalid TOTP %s' % (uid, totp))
+        print('%d of %d TOTP(s) valid, %.0f validations/s.' % (sum(ok), len(ok), len(ok)/t if t else 0))
+        sys.exit(0)
+
+    k = base64.b32decode(args[0])
     totp, s = TOTPT(k)
     print (f'Current TOTP is {totp} and will expire in {s} second(s).')